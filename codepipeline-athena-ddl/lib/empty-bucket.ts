@@ -1,6 +1,7 @@
-import fs = require('fs');
+import path = require('path');
 import cdk = require('@aws-cdk/core');
 import s3 = require('@aws-cdk/aws-s3');
+import iam = require('@aws-cdk/aws-iam');
 import lambda = require('@aws-cdk/aws-lambda');
 import cfn = require('@aws-cdk/aws-cloudformation');
 import { Duration } from '@aws-cdk/core';
@@ -17,23 +18,42 @@ export class EmptyBucketOnDelete extends cdk.Construct {
     constructor(scope: cdk.Construct, id: string, props: EmptyBucketOnDeleteProps) {
         super(scope, id);
 
-        const lambdaSource = fs.readFileSync('lambda/empty-bucket.py').toString();
+        // cfnresponse is shared with the other custom resources through a layer
+        const cfnResponseLayer = new lambda.LayerVersion(this, 'CfnResponseLayer', {
+            code: lambda.Code.fromAsset(path.join(__dirname, '../../shared/cfnresponse')),
+            compatibleRuntimes: [lambda.Runtime.PYTHON_3_7]
+        });
 
         const emptyBucketLambda =  new lambda.Function(this, 'EmptyBucketLambda', {
             runtime: lambda.Runtime.PYTHON_3_7,
             timeout: Duration.minutes(15),
-            code: lambda.Code.inline(lambdaSource),
-            handler: 'index.empty_bucket',
+            // the same emptier is used by every project in this repository
+            code: lambda.Code.fromAsset(path.join(__dirname, '../../shared/empty-bucket')),
+            handler: 'empty-bucket.empty_bucket',
+            layers: [cfnResponseLayer],
             memorySize: 512,
             environment: {
                 bucket_name: props.bucket.bucketName,
-            }        
+            }
         });
 
         props.bucket.grantReadWrite(emptyBucketLambda);
 
+        // large buckets are emptied over several invocations, each one starting the next. This is a
+        // separate policy because grantInvoke would make the function depend on its own ARN.
+        const reinvokePolicy = new iam.Policy(this, 'ReinvokePolicy', {
+            roles: [emptyBucketLambda.role!],
+            statements: [new iam.PolicyStatement({
+                actions: ['lambda:InvokeFunction'],
+                resources: [emptyBucketLambda.functionArn]
+            })]
+        });
+
         this.customResource = new cfn.CfnCustomResource(this, 'EmptyBucketResource', {
             serviceToken: CustomResourceProvider.lambda(emptyBucketLambda).serviceToken
         });
+
+        // keep the permission until the bucket has been emptied on delete
+        this.customResource.node.addDependency(reinvokePolicy);
     }
 }
\ No newline at end of file
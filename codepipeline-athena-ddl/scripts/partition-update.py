@@ -1,20 +1,397 @@
 #!/usr/bin/python
 
-import sys, getopt, json
+import sys, getopt, json, os, random, time
 import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 
 glue = boto3.client('glue')
 s3 = boto3.client('s3')
 
+LIST_CONCURRENCY = 16
+# BatchCreatePartition takes up to 100 partitions per call
+MAX_PARTITIONS_PER_CALL = 100
+REGISTER_CONCURRENCY = 4
+# SQS messages to collect before registering their partitions in one go
+QUEUE_BATCH = 100
+# GetPartitions can be split into up to 10 segments read in parallel
+PARTITION_SEGMENTS = 4
+MAX_ATTEMPTS = 6
+RETRYABLE_ERRORS = ('ThrottlingException', 'InternalServiceException', 'OperationTimeoutException',
+                    'ConcurrentModificationException')
+
+
+def list_partition_directories(bucket, prefix):
+    """
+    list the key=value directories directly under prefix, without listing the files in it
+    :return: (name, value, prefix) for each directory
+    """
+    directories = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            directory = common_prefix['Prefix'][len(prefix):].rstrip('/')
+            if '=' in directory:
+                name, value = directory.split('=', 1)
+                directories.append((name, value, common_prefix['Prefix']))
+    return directories
+
+
+def discover_partitions(bucket, prefix, partition_keys, concurrency=LIST_CONCURRENCY):
+    """
+    walk the key=value directories of a table one partition level at a time, listing every
+    directory of a level in parallel. Only directories are listed, so this takes as long as
+    the number of partitions rather than the number of objects.
+    :param partition_keys: the names of the table's partition columns, in order
+    :return: {partition values tuple: location}
+    """
+    level = [((), prefix.rstrip('/') + '/')]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for key in partition_keys:
+            children = pool.map(lambda item: list_partition_directories(bucket, item[1]), level)
+            next_level = []
+            for (values, _), directories in zip(level, children):
+                for name, value, directory in directories:
+                    if name.lower() != key.lower():
+                        print('skipping s3://{}/{}, expected a {} directory'.format(bucket, directory, key))
+                        continue
+                    next_level.append((values + (value,), directory))
+            level = next_level
+    return {values: 's3://{}/{}'.format(bucket, directory.rstrip('/')) for values, directory in level}
+
+
+def _backoff(attempt):
+    time.sleep(0.2 * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def get_partition_values(account_id, database_name, table_name):
+    """
+    :return: the set of value tuples of every partition the table already has
+    """
+    def read_segment(segment):
+        values = set()
+        paginator = glue.get_paginator('get_partitions')
+        for page in paginator.paginate(CatalogId=account_id, DatabaseName=database_name, TableName=table_name,
+                                       Segment={'SegmentNumber': segment, 'TotalSegments': PARTITION_SEGMENTS}):
+            values.update(tuple(partition['Values']) for partition in page['Partitions'])
+        return values
+
+    with ThreadPoolExecutor(max_workers=PARTITION_SEGMENTS) as pool:
+        return set().union(*pool.map(read_segment, range(PARTITION_SEGMENTS)))
+
+
+def table_version(table):
+    """
+    :return: what tells one definition of a table from the next, a dropped and recreated
+        table has a new CreateTime and an altered one a new UpdateTime
+    """
+    return [str(table.get('CreateTime')), str(table.get('UpdateTime'))]
+
+
+class PartitionCache:
+    """
+    the partition values known to exist for a table, kept in a local json file between runs
+    so the catalog only has to be read when there is no cache yet. The cache is stamped with
+    the table version it was read for and ignored once the table has been recreated or altered.
+    """
+
+    def __init__(self, directory, database_name, table_name):
+        self.path = os.path.join(directory, '{}.{}.json'.format(database_name, table_name))
+
+    def _decode(self, cached, version):
+        if not isinstance(cached, dict) or cached.get('table_version') != version:
+            return None
+        return set(tuple(values) for values in cached['partitions'])
+
+    def _encode(self, known, version):
+        return json.dumps({'table_version': version, 'partitions': sorted(known)})
+
+    def load(self, version):
+        try:
+            with open(self.path) as f:
+                return self._decode(json.load(f), version)
+        except FileNotFoundError:
+            return None
+
+    def save(self, known, version):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self._encode(known, version))
+        os.replace(tmp_path, self.path)
+
+
+class S3PartitionCache(PartitionCache):
+    """
+    the same cache kept as an object in S3, for Lambda functions and builds without a disk that lasts
+    """
+
+    def __init__(self, location, database_name, table_name):
+        self.bucket, _, prefix = location[5:].partition('/')
+        prefix = prefix.strip('/')
+        self.key = '{}{}.{}.json'.format(prefix + '/' if prefix else '', database_name, table_name)
+
+    def load(self, version):
+        try:
+            body = s3.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return self._decode(json.loads(body), version)
+
+    def save(self, known, version):
+        s3.put_object(Bucket=self.bucket, Key=self.key, Body=self._encode(known, version).encode('utf-8'),
+                      ContentType='application/json')
+
+
+def partition_cache(location, database_name, table_name):
+    if location.startswith('s3://'):
+        return S3PartitionCache(location, database_name, table_name)
+    return PartitionCache(location, database_name, table_name)
+
+
+def create_partitions(account_id, database_name, table_name, partition_inputs):
+    """
+    create one chunk of partitions, resubmitting those that fail with a retryable error.
+    Partitions that already exist count as created.
+    :return: the value tuples that were created or already existed
+    """
+    created = set()
+    pending = partition_inputs
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            response = glue.batch_create_partition(CatalogId=account_id, DatabaseName=database_name,
+                                                   TableName=table_name, PartitionInputList=pending)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in RETRYABLE_ERRORS or attempt == MAX_ATTEMPTS:
+                raise
+            _backoff(attempt)
+            continue
+
+        retry = set()
+        failed = {}
+        for error in response.get('Errors', []):
+            values = tuple(error['PartitionValues'])
+            code = error['ErrorDetail']['ErrorCode']
+            if code in RETRYABLE_ERRORS:
+                retry.add(values)
+            elif code != 'AlreadyExistsException':
+                failed[values] = '{}: {}'.format(code, error['ErrorDetail'].get('ErrorMessage'))
+        for values, message in failed.items():
+            print('could not create partition {}: {}'.format(list(values), message))
+        created.update(tuple(partition['Values']) for partition in pending
+                       if tuple(partition['Values']) not in retry and tuple(partition['Values']) not in failed)
+        pending = [partition for partition in pending if tuple(partition['Values']) in retry]
+        if not pending:
+            return created
+        if attempt < MAX_ATTEMPTS:
+            _backoff(attempt)
+    print('gave up on {} partitions after {} attempts'.format(len(pending), MAX_ATTEMPTS))
+    return created
+
+
+def register_partitions(account_id, database_name, table_name, partition_inputs):
+    """
+    create partitions in chunks of 100, several chunks at a time
+    :return: the value tuples that now exist
+    """
+    chunks = [partition_inputs[i:i + MAX_PARTITIONS_PER_CALL]
+              for i in range(0, len(partition_inputs), MAX_PARTITIONS_PER_CALL)]
+    with ThreadPoolExecutor(max_workers=REGISTER_CONCURRENCY) as pool:
+        results = pool.map(lambda chunk: create_partitions(account_id, database_name, table_name, chunk), chunks)
+        return set().union(*results)
+
+
+def s3_objects_from_event(event):
+    """
+    the objects created in an S3 notification, delivered directly, as the body of SQS messages
+    or through SNS
+    :return: (bucket, key) for each object, with the key url decoded
+    """
+    if 'Message' in event:
+        # an SNS notification forwarded to SQS
+        event = json.loads(event['Message'])
+    objects = []
+    for record in event.get('Records', []):
+        if 'body' in record:
+            objects.extend(s3_objects_from_event(json.loads(record['body'])))
+        elif 'Sns' in record:
+            objects.extend(s3_objects_from_event(json.loads(record['Sns']['Message'])))
+        elif record.get('eventName', '').startswith('ObjectCreated:'):
+            objects.append((record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])))
+    return objects
+
+
+def partition_from_key(bucket, key, prefix, partition_keys):
+    """
+    :return: (partition values tuple, location) of the key=value directories an object is in,
+        or None if the object is not in a partition of the table
+    """
+    prefix = prefix.rstrip('/') + '/'
+    if not key.startswith(prefix):
+        return None
+    directories = key[len(prefix):].split('/')[:-1][:len(partition_keys)]
+    if len(directories) < len(partition_keys):
+        return None
+    values = []
+    for directory, partition_key in zip(directories, partition_keys):
+        name, equals, value = directory.partition('=')
+        if not equals or name.lower() != partition_key.lower():
+            return None
+        values.append(value)
+    return tuple(values), 's3://{}/{}{}'.format(bucket, prefix, '/'.join(directories))
+
+
+class PartitionUpdater:
+    """
+    registers partitions of one table that are not known yet. The table definition and the
+    known partitions are read once and kept in memory, so a warm Lambda or a queue drain only
+    calls Glue for partitions it has never seen. Long lived updaters call check_table before
+    each batch to start over when the table has been recreated or altered.
+    """
+
+    def __init__(self, account_id, database_name, table_name, prefix, cache, refresh=False):
+        self.account_id = account_id
+        self.database_name = database_name
+        self.table_name = table_name
+        self.prefix = prefix
+        self.cache = cache
+        self._load(self._get_table(), refresh)
+
+    def _get_table(self):
+        # Load the table created above to get the StorageDescriptor def for columns, etc.
+        return glue.get_table(CatalogId=self.account_id, DatabaseName=self.database_name,
+                              Name=self.table_name)['Table']
+
+    def _load(self, table, refresh):
+        self.version = table_version(table)
+        self.storage_descriptor = table['StorageDescriptor']
+        self.partition_keys = [key['Name'] for key in table.get('PartitionKeys', [])]
+
+        self.known = None if refresh else self.cache.load(self.version)
+        self._unsaved = self.known is None
+        if self.known is None:
+            self.known = get_partition_values(self.account_id, self.database_name, self.table_name)
+            print('{}.{} has {} partitions in the catalog'.format(self.database_name, self.table_name, len(self.known)))
+
+    def check_table(self):
+        """
+        forget the known partitions when the table changed since they were read
+        """
+        table = self._get_table()
+        if table_version(table) != self.version:
+            print('{}.{} changed, reading its partitions again'.format(self.database_name, self.table_name))
+            self._load(table, refresh=True)
+
+    def register(self, partitions):
+        """
+        :param partitions: {partition values tuple: location}
+        :return: (number of partitions that were not known, number of those that now exist)
+        """
+        new_partitions = [{'StorageDescriptor': dict(self.storage_descriptor, Location=location), 'Values': list(values)}
+                          for values, location in sorted(partitions.items()) if values not in self.known]
+        created = register_partitions(self.account_id, self.database_name, self.table_name, new_partitions)
+        if created or self._unsaved:
+            if not self._unsaved:
+                # other runs may have saved partitions since this one loaded the cache
+                self.known |= self.cache.load(self.version) or set()
+            self.known |= created
+            self.cache.save(self.known, self.version)
+            self._unsaved = False
+        return len(new_partitions), len(created)
+
+    def register_objects(self, objects):
+        """
+        register the partitions the given (bucket, key) objects were written to
+        """
+        partitions = {}
+        for bucket, key in objects:
+            partition = partition_from_key(bucket, key, self.prefix, self.partition_keys)
+            if partition:
+                partitions[partition[0]] = partition[1]
+        return self.register(partitions)
+
+
+def drain_queue(queue_url, updater, batch_size=QUEUE_BATCH):
+    """
+    read S3 notifications from an SQS queue until it is empty, registering the partitions of up
+    to batch_size messages at a time and deleting the messages once their partitions exist
+    :return: False if some partitions could not be registered
+    """
+    sqs = boto3.client('sqs')
+    while True:
+        messages = []
+        while len(messages) < batch_size:
+            received = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10,
+                                           WaitTimeSeconds=1).get('Messages', [])
+            if not received:
+                break
+            messages.extend(received)
+        if not messages:
+            return True
+
+        objects = s3_objects_from_event({'Records': [{'body': message['Body']} for message in messages]})
+        updater.check_table()
+        new, created = updater.register_objects(objects)
+        print('{} messages, {} objects: registered {} of {} new partitions'.format(
+            len(messages), len(objects), created, new))
+        if created < new:
+            # the messages become visible again and are retried by the next run
+            return False
+        for i in range(0, len(messages), 10):
+            sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+                {'Id': str(j), 'ReceiptHandle': message['ReceiptHandle']} for j, message in enumerate(messages[i:i + 10])])
+
+
+_updater = None
+
+
+def handler(event, context):
+    """
+    Lambda entry point for S3 notifications, directly or through SQS or SNS. The table is taken from
+    the ACCOUNT_ID, DATABASE_NAME, TABLE_NAME and PREFIX environment variables and the known partitions
+    are cached at PARTITION_CACHE, an s3:// location.
+    """
+    global _updater
+    if _updater is None:
+        database_name = os.environ['DATABASE_NAME']
+        table_name = os.environ['TABLE_NAME']
+        _updater = PartitionUpdater(os.environ['ACCOUNT_ID'], database_name, table_name, os.environ['PREFIX'],
+                                    partition_cache(os.environ['PARTITION_CACHE'], database_name, table_name))
+    else:
+        # the warm updater outlives deploys that drop and create the table
+        _updater.check_table()
+
+    objects = s3_objects_from_event(event)
+    new, created = _updater.register_objects(objects)
+    print('{} objects: registered {} of {} new partitions'.format(len(objects), created, new))
+    if created < new:
+        # fail the batch so it is redelivered, partitions that were created count as existing next time
+        raise RuntimeError('could not register {} partitions'.format(new - created))
+
+
 def main(argv):
+    usage = ('partition-update.py -b <bucket> -p <prefix> -a <account_id> -d <database_name> -t <table_name> '
+             '[-c <cache_dir>] [-r] [-q <queue_url>]')
     try:
-        opts, args = getopt.getopt(argv,"hb:p:a:d:t:",["bucket=","prefix=","account_id=","database_name=","table_name="])
+        opts, args = getopt.getopt(argv,"hb:p:a:d:t:c:rq:",["bucket=","prefix=","account_id=","database_name=","table_name=",
+                                                        "cache_dir=","refresh","queue_url="])
     except getopt.GetoptError:
-        print('partition-update.py -b <bucket> -p <prefix> -a <account_id> -d <database_name> -t <table_name>')
+        print(usage)
         sys.exit(2)
+    cache_dir = '.partition-cache'
+    refresh = False
+    queue_url = None
     for opt, arg in opts:
         if opt == '-h':
-            print('partition-update.py -b <bucket> -p <prefix> -a <account_id> -d <database_name> -t <table_name>')
+            print(usage)
+            print('    -c: directory or s3:// location to cache the known partitions of each table in')
+            print('    -r: read the existing partitions from the catalog instead of the cache')
+            print('    -q: register the partitions of the S3 notifications on an SQS queue instead of listing the bucket')
             sys.exit()
         elif opt in ("-b", "--bucket"):
             bucket = arg
@@ -25,43 +402,38 @@ def main(argv):
         elif opt in ("-d", "--database_name"):
             database_name = arg
         elif opt in ("-t", "--table_name"):
-            table_name = arg                                    
-        
-    bucket = bucket[5:-1]
-
-    response = s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix
-    )
-
-    location = 's3://{0}/{1}'.format(bucket,prefix)
-
-    # Load the table created above to get the StorageDescriptor def for columns, etc.
-    streaming_table = glue.get_table(
-        CatalogId=account_id,
-        DatabaseName=database_name,
-        Name=table_name
-    )
-
-    storage_descriptor= streaming_table['Table']['StorageDescriptor']
-
-    # De-dupe partitions if there are any
-    partitions = set()
-    for obj in response['Contents']:
-        # remove the first prefix for the table data lake location above and the last entry for the file
-        keys =  obj['Key'].split('/')[1:-1]
-        # get the values of the prefixes in between. These are the year,month,day,hour values to be used for the partition
-        values = [k.split('=')[1] for k in keys]
-        storage_descriptor['Location'] = '{0}/{1}'.format(location, '/'.join(keys))
-        partitions.add(json.dumps({"StorageDescriptor": storage_descriptor ,"Values": list(values)}))
-
-    print(partitions)
-    #batch add partitions
-    response = glue.batch_create_partition(
-        CatalogId=account_id,
-        DatabaseName=database_name,
-        TableName=table_name,
-        PartitionInputList=list(json.loads(part) for part in partitions)
-    )
+            table_name = arg
+        elif opt in ("-c", "--cache_dir"):
+            cache_dir = arg
+        elif opt in ("-r", "--refresh"):
+            refresh = True
+        elif opt in ("-q", "--queue_url"):
+            queue_url = arg
+
+    updater = PartitionUpdater(account_id, database_name, table_name, prefix,
+                               partition_cache(cache_dir, database_name, table_name), refresh)
+    if not updater.partition_keys:
+        print('{}.{} is not partitioned'.format(database_name, table_name))
+        return
+
+    if queue_url:
+        if not drain_queue(queue_url, updater):
+            sys.exit(1)
+        return
+
+    # the bucket is passed as s3://bucket/
+    if bucket.startswith('s3://'):
+        bucket = bucket[5:]
+    bucket = bucket.strip('/')
+
+    # one entry per partition however many objects it holds
+    partitions = discover_partitions(bucket, prefix, updater.partition_keys)
+    print('found {} partitions under s3://{}/{}'.format(len(partitions), bucket, prefix))
+
+    #batch add the partitions the table does not have yet
+    new, created = updater.register(partitions)
+    print('registered {} of {} new partitions'.format(created, new))
+    if created < new:
+        sys.exit(1)
 if __name__ == "__main__":
-    main(sys.argv[1:])
\ No newline at end of file
+    main(sys.argv[1:])
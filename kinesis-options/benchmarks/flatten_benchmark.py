@@ -0,0 +1,237 @@
+#!/usr/bin/python
+"""
+benchmarks for lambda/flatten-json.py on Kinesis and Firehose style payloads, and for
+its Firehose transformation handler on synthetic batches
+
+    python benchmarks/flatten_benchmark.py [-n <records>]
+"""
+
+import base64
+import getopt
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+
+
+def load_lambda_module(file_name):
+    # the lambda sources have dashes in their names so they cannot be imported directly
+    path = os.path.join(LAMBDA_DIR, file_name)
+    spec = importlib.util.spec_from_file_location(file_name.replace('-', '_')[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+flatten_json = load_lambda_module('flatten-json.py')
+
+
+def recursive_flatten(a_dict):
+    """
+    the original recursive implementation, kept as the baseline
+    """
+    d_return = dict()
+    for k, v in a_dict.items():
+        d_return.update(_recursive_f(k, v))
+    return d_return
+
+
+def _recursive_f(k, o):
+    return_dict = {}
+    if isinstance(o, list):
+        for i, j in enumerate(o):
+            return_dict.update(_recursive_f('{}.{}'.format(k, i), j))
+    elif isinstance(o, dict):
+        for l, v in o.items():
+            return_dict.update(_recursive_f('{}.{}'.format(k, l), v))
+    else:
+        return_dict = {k: o}
+    return return_dict
+
+
+def kinesis_record(rnd):
+    # a Kinesis stream record as delivered to a Lambda consumer, with a small json body
+    return {
+        'kinesis': {
+            'kinesisSchemaVersion': '1.0',
+            'partitionKey': str(rnd.randint(0, 1000)),
+            'sequenceNumber': str(rnd.getrandbits(120)),
+            'data': {'sensor': 'sensor-{}'.format(rnd.randint(0, 50)), 'temperature': rnd.random() * 40,
+                     'humidity': rnd.random(), 'tags': ['a', 'b', 'c']},
+            'approximateArrivalTimestamp': 1545084650.987
+        },
+        'eventSource': 'aws:kinesis',
+        'eventVersion': '1.0',
+        'eventID': 'shardId-000000000006:{}'.format(rnd.getrandbits(64)),
+        'eventName': 'aws:kinesis:record',
+        'awsRegion': 'us-east-2'
+    }
+
+
+def region_event(rnd):
+    # the covid region_events payload delivered by the Firehose pipeline
+    return {
+        'fips': rnd.randint(1000, 99999),
+        'admin2': 'County', 'province_state': 'State', 'country_region': 'US',
+        'last_update': '2020-04-20 23:36:47',
+        'location': {'latitude': rnd.uniform(-90, 90), 'longitude': rnd.uniform(-180, 180)},
+        'counts': {'confirmed': rnd.randint(0, 1000), 'deaths': rnd.randint(0, 100),
+                   'recovered': rnd.randint(0, 500), 'active': rnd.randint(0, 500)},
+        'combined_key': 'County, State, US'
+    }
+
+
+def nested_document(rnd, depth, width):
+    """
+    a synthetic document with the given nesting depth and number of keys per level
+    """
+    if depth == 0:
+        return rnd.random()
+    doc = {}
+    for i in range(width):
+        if i == 0:
+            doc['k{}'.format(i)] = [nested_document(rnd, depth - 1, width) for _ in range(2)]
+        elif i == 1:
+            doc['k{}'.format(i)] = nested_document(rnd, depth - 1, width)
+        else:
+            doc['k{}'.format(i)] = rnd.random()
+    return doc
+
+
+def payloads(records):
+    rnd = random.Random(42)
+    yield 'kinesis record', [kinesis_record(rnd) for _ in range(records)]
+    yield 'firehose region event', [region_event(rnd) for _ in range(records)]
+    # the synthetic documents hold hundreds to thousands of leaves each, so fewer are needed
+    for depth, width in ((4, 4), (8, 3), (3, 30)):
+        count = max(1, records // 4 ** (depth // 2 + 1))
+        yield 'depth {} width {}'.format(depth, width), [nested_document(rnd, depth, width) for _ in range(count)]
+
+
+def run(name, implementations, documents, repeat=5):
+    reference = [recursive_flatten(doc) for doc in documents]
+    print(name)
+    baseline = None
+    for label, function in implementations:
+        if [function(doc) for doc in documents] != reference:
+            raise AssertionError('{} disagrees with the recursive implementation on {}'.format(label, name))
+        best = min(timeit.repeat(lambda: [function(doc) for doc in documents], number=1, repeat=repeat))
+        baseline = baseline or best
+        print('  {:<24} {:>10.0f} docs/s  {:>6.2f}x'.format(label, len(documents) / best, baseline / best))
+
+
+def firehose_event(rnd, records, docs_per_record):
+    """
+    a Firehose transformation event whose records each carry newline delimited region events
+    """
+    event = {'invocationId': 'benchmark', 'region': 'us-east-1',
+             'deliveryStreamArn': 'arn:aws:firehose:us-east-1:123456789012:deliverystream/benchmark',
+             'records': []}
+    for i in range(records):
+        data = ''.join(json.dumps(region_event(rnd)) + '\n' for _ in range(docs_per_record))
+        event['records'].append({'recordId': str(i), 'approximateArrivalTimestamp': 1587422207000,
+                                 'data': base64.b64encode(data.encode('utf-8')).decode('ascii')})
+    return event
+
+
+def run_handler(batches, repeat=5):
+    rnd = random.Random(42)
+    print('firehose handler ({} codec)'.format(flatten_json.JSON_CODEC))
+    for records, docs_per_record in ((100, 1), (500, 1), (500, 10)):
+        events = [firehose_event(rnd, records, docs_per_record) for _ in range(batches)]
+        input_bytes = sum(len(record['data']) for event in events for record in event['records'])
+        for response in (flatten_json.handler(event, None) for event in events):
+            assert all(record['result'] == 'Ok' for record in response['records'])
+        best = min(timeit.repeat(lambda: [flatten_json.handler(event, None) for event in events],
+                                 number=1, repeat=repeat))
+        print('  {:>3} records x {:>2} docs {:>10.0f} records/s {:>8.1f} MB/s'.format(
+            records, docs_per_record, batches * records / best, input_bytes / best / 1024 / 1024))
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        result = function()
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+def run_columns(records):
+    rnd = random.Random(42)
+    # half the events are missing their counts so the columns need null filling
+    documents = [region_event(rnd) for _ in range(records)]
+    for doc in documents[::2]:
+        del doc['counts']
+
+    print('columnar batch of {} region events'.format(records))
+    for label, function in (('list of dicts', lambda: [flatten_json.flatten(doc) for doc in documents]),
+                            ('columns', lambda: flatten_json.flatten_columns(documents))):
+        best = min(timeit.repeat(function, number=1, repeat=5))
+        peak, _ = peak_memory(function)
+        print('  {:<24} {:>10.0f} docs/s {:>8.1f} MB peak'.format(label, records / best, peak / 1024 / 1024))
+
+
+def run_stream(records):
+    rnd = random.Random(42)
+    # one large export document, a top level array of region events
+    body = json.dumps([region_event(rnd) for _ in range(records)]).encode('utf-8')
+
+    def load_and_flatten():
+        return sum(1 for _ in flatten_json.flatten(dict(enumerate(json.loads(body)))))
+
+    def stream():
+        return sum(1 for _ in flatten_json.iter_flatten_stream(io.BytesIO(body)))
+
+    print('single {:.1f} MB document'.format(len(body) / 1024 / 1024))
+    for label, function in (('load and flatten', load_and_flatten), ('streaming', stream)):
+        best = min(timeit.repeat(function, number=1, repeat=3))
+        peak, keys = peak_memory(function)
+        print('  {:<24} {:>10.0f} keys/s {:>8.1f} MB peak'.format(label, keys / best, peak / 1024 / 1024))
+
+
+def main(argv):
+    records = 10000
+    try:
+        opts, args = getopt.getopt(argv, "hn:", ["records="])
+    except getopt.GetoptError:
+        print('flatten_benchmark.py -n <records>')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('flatten_benchmark.py -n <records>')
+            sys.exit()
+        elif opt in ("-n", "--records"):
+            records = int(arg)
+
+    for name, documents in payloads(records):
+        implementations = [
+            ('recursive', recursive_flatten),
+            ('iterative', flatten_json.flatten),
+            # every document of a payload family has the same shape
+            ('compiled with shape key', flatten_json.CompiledFlattener(lambda doc: name)),
+        ]
+        run(name, implementations, documents)
+
+    # very deep input only works with the iterative implementation
+    deep = {}
+    node = deep
+    for _ in range(5000):
+        node['n'] = {}
+        node = node['n']
+    node['leaf'] = 1
+    print('depth 5000: {} keys'.format(len(flatten_json.flatten(deep))))
+
+    run_handler(batches=max(1, records // 1000))
+    run_columns(records)
+    run_stream(records)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
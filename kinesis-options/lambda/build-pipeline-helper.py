@@ -1,13 +1,115 @@
 import os
 import json
 import boto3
+import base64
+import hashlib
+import threading
 import traceback
 import cfnresponse
+import urllib.error
 import urllib.request
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
 s3client = boto3.client('s3')
 code_pipeline = boto3.client('codepipeline')
 
+# multipart uploads need parts of at least 5 MB, except for the last one
+PART_SIZE = int(os.environ.get('partSizeMb', '8')) * 1024 * 1024
+UPLOAD_CONCURRENCY = int(os.environ.get('uploadConcurrency', '4'))
+
+
+def read_part(stream, size):
+    """
+    read exactly size bytes, or fewer at the end of the stream
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _content_md5(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+
+def upload_stream(stream, bucket, key, part_size=PART_SIZE, concurrency=UPLOAD_CONCURRENCY, metadata=None):
+    """
+    copy a file object to S3 without holding it in memory. Parts are uploaded in parallel
+    and at most concurrency + 1 parts are in memory at a time. S3 checks the Content-MD5 of
+    every part, and the ETag of the finished object is checked against the part digests.
+    :param metadata: user metadata to store with the object
+    :return: the ETag of the new object
+    """
+    metadata = metadata or {}
+    data = read_part(stream, part_size)
+    if len(data) < part_size:
+        digest = hashlib.md5(data).digest()
+        response = s3client.put_object(Bucket=bucket, Key=key, Body=data, ContentMD5=_content_md5(digest),
+                                      Metadata=metadata)
+        return response['ETag']
+
+    upload_id = s3client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata)['UploadId']
+    in_flight = threading.BoundedSemaphore(concurrency)
+    failed = threading.Event()
+
+    def upload_part(part_number, part):
+        try:
+            digest = hashlib.md5(part).digest()
+            response = s3client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                            Body=part, ContentMD5=_content_md5(digest))
+            return {'PartNumber': part_number, 'ETag': response['ETag']}, digest
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            in_flight.release()
+
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            part_number = 1
+            # stop reading as soon as a part fails, the upload is aborted below
+            while data and not failed.is_set():
+                in_flight.acquire()
+                futures.append(pool.submit(upload_part, part_number, data))
+                part_number += 1
+                data = read_part(stream, part_size)
+        results = [future.result() for future in futures]
+
+        parts = [part for part, _ in results]
+        response = s3client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                      MultipartUpload={'Parts': parts})
+    except Exception:
+        s3client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    # part ETags are plain MD5s unless the bucket uses KMS encryption, in which case
+    # the per part Content-MD5 checks are all there is
+    digests = [digest for _, digest in results]
+    if all(part['ETag'].strip('"') == digest.hex() for part, digest in zip(parts, digests)):
+        expected = '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(parts))
+        if response['ETag'].strip('"') != expected:
+            raise ValueError('s3://{}/{} has ETag {}, expected {}'.format(bucket, key, response['ETag'], expected))
+    return response['ETag']
+
+
+def cached_source(bucket, key):
+    """
+    :return: the metadata of the copy from an earlier download, None if there is none
+    """
+    try:
+        return s3client.head_object(Bucket=bucket, Key=key)['Metadata']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
 
 def download_sources(event, context):
     url = os.environ['url']
@@ -17,9 +119,27 @@ def download_sources(event, context):
     try:
         if event['RequestType'] != 'Delete':
             req = urllib.request.Request(url)
-            response = urllib.request.urlopen(req)
 
-            s3client.put_object(Bucket=bucket, Key=key, Body=response.read())
+            # only fetch the archive again if the origin says it changed since the last copy
+            cached = cached_source(bucket, key)
+            if cached and cached.get('source-url') == url:
+                if cached.get('source-etag'):
+                    req.add_header('If-None-Match', cached['source-etag'])
+                if cached.get('source-last-modified'):
+                    req.add_header('If-Modified-Since', cached['source-last-modified'])
+
+            try:
+                with urllib.request.urlopen(req) as response:
+                    metadata = {'source-url': url}
+                    if response.headers.get('ETag'):
+                        metadata['source-etag'] = response.headers['ETag']
+                    if response.headers.get('Last-Modified'):
+                        metadata['source-last-modified'] = response.headers['Last-Modified']
+                    upload_stream(response, bucket, key, metadata=metadata)
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    raise
+                print('s3://{}/{} is up to date with {}'.format(bucket, key, url))
 
         cfnresponse.send(event, context, cfnresponse.SUCCESS, {})
     except Exception:
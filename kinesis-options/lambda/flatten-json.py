@@ -1,29 +1,532 @@
+import base64
+import codecs
+import json
+import re
+import sys
+import time
+from collections import OrderedDict
+
+# prefer a faster json codec when one is packaged with the function
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+    JSON_CODEC = 'orjson'
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    JSON_CODEC = 'json'
+
+# the synchronous Lambda response limit is 6 MB, leave room for the response envelope
+MAX_RESPONSE_BYTES = 6000000
+# json overhead of one output record besides its id and data
+RECORD_OVERHEAD_BYTES = 64
+
+
 def flatten(a_dict: dict):
     """
-    remove all nested structures from a dictionary by flattening it
+    remove all nested structures from a dictionary by flattening it. Nested keys are
+    joined with dots and list items use their index, e.g. {'a': {'b': [{'c': 1}]}}
+    becomes {'a.b.0.c': 1}. Empty lists and dictionaries produce no keys.
     :param a_dict: a dictionary
     :return: a flattened dictionary
     """
     d_return = dict()
-    for k, v in a_dict.items():
-        d_return.update(__f(k, v))
+    # walk the document with an explicit stack of (key prefix, child iterator) so deep
+    # documents never hit the recursion limit and every key is written exactly once
+    stack = [(None, iter(a_dict.items()))]
+    while stack:
+        prefix, children = stack[-1]
+        for k, o in children:
+            if prefix is not None:
+                k = f'{prefix}.{k}'
+            if isinstance(o, dict):
+                if o:
+                    stack.append((k, iter(o.items())))
+                    break
+            elif isinstance(o, list):
+                if o:
+                    stack.append((k, enumerate(o)))
+                    break
+            else:
+                d_return[k] = o
+        else:
+            stack.pop()
     return d_return
 
 
-def __f(k, o):
+def _compile_accessor(a_dict: dict):
+    """
+    generate a function that builds the flattened dictionary of a record straight from its
+    leaves, checking on the way that every container has the type and length it has in
+    a_dict and that every leaf is still a leaf, e.g.
+        def accessor(r):
+            if len(r) != 2: return None
+            n0 = r[c0]
+            if not isinstance(n0, dict) or len(n0) != 1: return None
+            n1 = n0[c1]
+            if isinstance(n1, _containers): return None
+            ...
+            return {k0: n1, ...}
+    :return: the accessor, which returns None for a record with another structure
+    """
+    namespace = {'_containers': (dict, list)}
+    lines = ['def accessor(r):', f'    if len(r) != {len(a_dict)}: return None']
+    items = []
+    stack = [(None, 'r', iter(a_dict.items()))]
+    while stack:
+        prefix, node, children = stack[-1]
+        for k, o in children:
+            i = len(namespace)
+            namespace[f'c{i}'] = k
+            var = f'n{i}'
+            lines.append(f'    {var} = {node}[c{i}]')
+            if prefix is not None:
+                k = f'{prefix}.{k}'
+            if isinstance(o, (dict, list)):
+                container = 'dict' if isinstance(o, dict) else 'list'
+                lines.append(f'    if not isinstance({var}, {container}) or len({var}) != {len(o)}: return None')
+                if o:
+                    stack.append((k, var, iter(o.items()) if isinstance(o, dict) else enumerate(o)))
+                    break
+            else:
+                lines.append(f'    if isinstance({var}, _containers): return None')
+                namespace[f'k{i}'] = sys.intern(k) if isinstance(k, str) else k
+                items.append(f'k{i}: {var}')
+        else:
+            stack.pop()
+    lines.append('    return {' + ', '.join(items) + '}')
+    exec('\n'.join(lines), namespace)
+    return namespace['accessor']
+
+
+class CompiledFlattener:
+    """
+    flattens records that share a small number of shapes by caching a plan per shape.
+    The caller tells shapes apart without walking the record, e.g. from a schema or event
+    type field, and the plan is a generated accessor that reads the leaves directly with
+    interned output keys, so no key string is formatted again once a shape has been seen.
+    The accessor only checks that each container has the type and length the plan expects.
+    Records whose structure does not match the plan of their shape key fall back to
+    flatten(), so a shape key that misses a difference costs time but not data.
+    """
+
+    def __init__(self, shape_key, max_shapes: int = 256):
+        """
+        :param shape_key: a function returning a hashable shape for a record
+        :param max_shapes: the number of plans kept, least recently used plans are evicted first
+        """
+        self.shape_key = shape_key
+        self.max_shapes = max_shapes
+        self.plans = OrderedDict()
+
+    def __call__(self, a_dict: dict):
+        accessor = self._plan(self.shape_key(a_dict), a_dict)
+        try:
+            flattened = accessor(a_dict)
+        except (KeyError, IndexError, TypeError):
+            flattened = None
+        return flatten(a_dict) if flattened is None else flattened
+
+    def _plan(self, shape, a_dict):
+        """
+        :return: the generated accessor for a shape key
+        """
+        plan = self.plans.get(shape)
+        if plan is None:
+            plan = self.plans[shape] = _compile_accessor(a_dict)
+            if len(self.plans) > self.max_shapes:
+                self.plans.popitem(last=False)
+        else:
+            self.plans.move_to_end(shape)
+        return plan
+
+
+def flatten_columns(records, flattener: CompiledFlattener = None):
+    """
+    flatten a batch of records straight into columns, one list per flattened key. A record
+    that lacks a key gets None in that column, so every column has one value per record.
+    :param records: an iterable of dictionaries
+    :param flattener: a CompiledFlattener for records of known shapes, flatten() by default
+    :return: a dictionary of flattened key to list of values
+    """
+    flattener = flattener or flatten
+    columns = {}
+    count = 0
+    for record in records:
+        for key, value in flattener(record).items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * count
+            elif len(column) > count:
+                # the key was already produced by this record, the last value wins as in flatten()
+                column[count] = value
+                continue
+            elif len(column) < count:
+                column.extend([None] * (count - len(column)))
+            column.append(value)
+        count += 1
+
+    for column in columns.values():
+        if len(column) < count:
+            column.extend([None] * (count - len(column)))
+    return columns
+
+
+def columns_to_arrow(columns: dict):
+    """
+    convert the output of flatten_columns to a pyarrow Table. Columns holding values of
+    mixed types are stored as strings, with non-string values json encoded.
+    """
+    import pyarrow as pa
+
+    arrays = {}
+    for name, values in columns.items():
+        try:
+            arrays[name] = pa.array(values)
+        except (TypeError, ValueError):
+            arrays[name] = pa.array([v if v is None or isinstance(v, str) else json.dumps(v) for v in values],
+                                    type=pa.string())
+    return pa.table(arrays)
+
+
+def write_parquet(columns: dict, where, compression: str = 'snappy'):
+    """
+    write the output of flatten_columns to a parquet file
+    :param where: a path or writable file object
+    """
+    import pyarrow.parquet as pq
+
+    pq.write_table(columns_to_arrow(columns), where, compression=compression)
+
+
+# a json string body up to its closing quote, allowing escaped quotes
+_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR = re.compile(r'[^\s,:\]\}]*')
+_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+_LITERALS = {'true': True, 'false': False, 'null': None}
+_SCALAR_EVENTS = {True: 'boolean', False: 'boolean', None: 'null'}
+STREAM_READ_SIZE = 64 * 1024
+
+# the tokens json_events accepts next, the first and last come before and after the top level value
+_VALUE, _VALUE_OR_END, _KEY, _KEY_OR_END, _COLON, _COMMA_OR_END, _DONE = range(7)
+_VALUE_STATES = (_VALUE, _VALUE_OR_END)
+_EXPECTED = {_VALUE: 'a value', _VALUE_OR_END: 'a value or ]', _KEY: 'a key', _KEY_OR_END: 'a key or }',
+             _COLON: ':', _COMMA_OR_END: ', or the end of the object or array', _DONE: 'the end of the document'}
+
+
+def _read_text(fp, size):
+    """
+    read text from a binary or text file object, decoding utf-8 across chunk boundaries
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        chunk = fp.read(size)
+        if not chunk:
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+            return
+        yield decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+
+def json_events(fp, read_size: int = STREAM_READ_SIZE):
     """
-    recursive function to perform the flattening of the dictionary
-    :param k: a key
-    :param o: an object or primitive
-    :return: a dictionary with no nested structures
+    incrementally tokenize a json document into (event, value) pairs using the same event
+    names as ijson.basic_parse: start_map, map_key, end_map, start_array, end_array,
+    string, number, boolean and null. Only the current chunk and the token being parsed
+    are held in memory. The grammar is checked token by token, so a malformed document
+    raises ValueError at the first token out of place rather than producing events.
+    :param fp: a file object opened in binary or text mode, or anything with read(size)
     """
-    return_dict = {}
-    if isinstance(o, list):
-        for i, j in enumerate(o):
-            return_dict.update(__f('{}.{}'.format(k, i), j))
-    elif isinstance(o, dict):
-        for l, v in o.items():
-            return_dict.update(__f('{}.{}'.format(k, l), v))
+    chunks = _read_text(fp, read_size)
+    buf = ''
+    pos = 0
+    eof = False
+    # for each open container whether it is an object
+    containers = []
+    state = _VALUE
+
+    def more():
+        nonlocal buf, pos, eof
+        for chunk in chunks:
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+        eof = True
+        return False
+
+    def unexpected(token):
+        return ValueError('unexpected {!r} in json document, expected {}'.format(token[:32], _EXPECTED[state]))
+
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\n\r':
+            pos += 1
+        if pos >= len(buf):
+            if more():
+                continue
+            break
+
+        c = buf[pos]
+        if c == '{' or c == '[':
+            if state not in _VALUE_STATES:
+                raise unexpected(c)
+            pos += 1
+            containers.append(c == '{')
+            state = _KEY_OR_END if c == '{' else _VALUE_OR_END
+            yield ('start_map' if c == '{' else 'start_array'), None
+            continue
+        elif c == '}' or c == ']':
+            is_map = c == '}'
+            if (state != _COMMA_OR_END and state != (_KEY_OR_END if is_map else _VALUE_OR_END)) \
+                    or containers[-1] != is_map:
+                raise unexpected(c)
+            pos += 1
+            containers.pop()
+            yield ('end_map' if is_map else 'end_array'), None
+        elif c == ',':
+            if state != _COMMA_OR_END:
+                raise unexpected(c)
+            pos += 1
+            state = _KEY if containers[-1] else _VALUE
+            continue
+        elif c == ':':
+            if state != _COLON:
+                raise unexpected(c)
+            pos += 1
+            state = _VALUE
+            continue
+        elif c == '"':
+            if state not in _VALUE_STATES and state != _KEY and state != _KEY_OR_END:
+                raise unexpected(c)
+            # a long string spans many chunks, each piece is scanned once and joined at the end
+            pieces = []
+            scan = pos + 1
+            match = _STRING_REST.match(buf, scan)
+            while match is None:
+                # an escape split by the chunk boundary stays in the buffer for the next scan
+                end = len(buf)
+                if (end - len(buf.rstrip('\\'))) % 2:
+                    end -= 1
+                pieces.append(buf[scan:end])
+                pos = end
+                if not more():
+                    raise ValueError('unterminated string in json document')
+                scan = 0
+                match = _STRING_REST.match(buf, scan)
+            pieces.append(buf[scan:match.end()])
+            pos = match.end()
+            token = ''.join(pieces)
+            value = json.loads('"' + token) if '\\' in token else token[:-1]
+            if state == _KEY or state == _KEY_OR_END:
+                state = _COLON
+                yield 'map_key', value
+                continue
+            yield 'string', value
+        else:
+            pieces = []
+            match = _SCALAR.match(buf, pos)
+            # a scalar that runs to the end of the buffer may continue in the next chunk
+            while match.end() == len(buf) and not eof:
+                pieces.append(buf[pos:])
+                pos = len(buf)
+                if not more():
+                    break
+                match = _SCALAR.match(buf, pos)
+            pieces.append(buf[pos:match.end()])
+            token = ''.join(pieces) or c
+            if state not in _VALUE_STATES:
+                raise unexpected(token)
+            pos = match.end()
+            if token in _LITERALS:
+                value = _LITERALS[token]
+                yield _SCALAR_EVENTS[value], value
+            elif _NUMBER.fullmatch(token):
+                yield 'number', json.loads(token)
+            else:
+                raise unexpected(token)
+
+        # a value or a container just ended
+        state = _COMMA_OR_END if containers else _DONE
+
+    if state != _DONE:
+        raise ValueError('json document ended early, expected {}'.format(_EXPECTED[state]))
+
+
+def _stream_events(fp, read_size):
+    # the ijson C backend tokenizes much faster than json_events when it is packaged
+    try:
+        import ijson
+    except ImportError:
+        return json_events(fp, read_size)
+    try:
+        return ijson.basic_parse(fp, buf_size=read_size, use_float=True)
+    except TypeError:
+        return ijson.basic_parse(fp, buf_size=read_size)
+
+
+def iter_flatten_stream(fp, read_size: int = STREAM_READ_SIZE):
+    """
+    flatten a json document while it is being parsed, yielding (flattened key, value) pairs
+    in the same order and format as flatten(). Memory grows with the nesting depth of the
+    document, not its size. A top level array is flattened as if it were an object keyed
+    by the array indexes.
+    :param fp: a file object opened in binary or text mode, e.g. an S3 get_object body
+    """
+    # one frame per open container: [flattened key prefix, is array, current key or next index]
+    frames = []
+    for event, value in _stream_events(fp, read_size):
+        if event == 'map_key':
+            frames[-1][2] = value
+            continue
+        if event == 'end_map' or event == 'end_array':
+            frames.pop()
+            continue
+
+        if frames:
+            frame = frames[-1]
+            child = frame[2]
+            if frame[1]:
+                frame[2] += 1
+            key = child if frame[0] is None else f'{frame[0]}.{child}'
+        else:
+            key = None
+
+        if event == 'start_map':
+            frames.append([key, False, None])
+        elif event == 'start_array':
+            frames.append([key, True, 0])
+        elif key is None:
+            raise ValueError('expected a json object or array, found a single {}'.format(event))
+        else:
+            yield key, value
+
+
+def iter_flatten_chunks(fp, chunk_size: int = 1000, read_size: int = STREAM_READ_SIZE):
+    """
+    flatten a json document while it is being parsed into flat dictionaries of at most
+    chunk_size keys each
+    """
+    chunk = {}
+    for key, value in iter_flatten_stream(fp, read_size):
+        chunk[key] = value
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = {}
+    if chunk:
+        yield chunk
+
+
+def transform(data: bytes):
+    """
+    flatten every json document of a newline delimited payload
+    :param data: the decoded record data
+    :return: the flattened newline delimited json, or None if the payload holds no documents
+    """
+    lines = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        doc = json_loads(line)
+        if not isinstance(doc, dict):
+            raise ValueError('expected a json object, found {}'.format(type(doc).__name__))
+        # the documents of a stream have no known shape to key plans on, and walking each
+        # one to find its shape costs more than flatten() saves
+        lines.append(json_dumps(flatten(doc)))
+    if not lines:
+        return None
+    return b'\n'.join(lines) + b'\n'
+
+
+def handler(event, context):
+    """
+    Firehose record transformation: flattens each record, and re-ingests whatever does
+    not fit in the 6 MB response so the output never exceeds the Lambda limit
+    """
+    output = []
+    reingest = []
+    response_size = 0
+    for record in event['records']:
+        try:
+            transformed = transform(base64.b64decode(record['data']))
+        except Exception:
+            result = {'recordId': record['recordId'], 'result': 'ProcessingFailed', 'data': record['data']}
+        else:
+            if transformed is None:
+                result = {'recordId': record['recordId'], 'result': 'Dropped'}
+            else:
+                result = {'recordId': record['recordId'], 'result': 'Ok',
+                          'data': base64.b64encode(transformed).decode('ascii')}
+
+        size = len(record['recordId']) + len(result.get('data', '')) + RECORD_OVERHEAD_BYTES
+        if 'data' in result and response_size + size > MAX_RESPONSE_BYTES:
+            # send the original back through the stream, it is transformed on a later invocation
+            reingest.append(record)
+            result = {'recordId': record['recordId'], 'result': 'Dropped'}
+            size = len(record['recordId']) + RECORD_OVERHEAD_BYTES
+        response_size += size
+        output.append(result)
+
+    if reingest:
+        print('re-ingesting {} of {} records to stay under the response limit'.format(
+            len(reingest), len(event['records'])))
+        reingest_records(event, reingest)
+
+    return {'records': output}
+
+
+def _batches(entries, max_count, max_bytes):
+    batch, size = [], 0
+    for entry in entries:
+        entry_size = len(entry['Data']) + len(entry.get('PartitionKey', ''))
+        if batch and (len(batch) == max_count or size + entry_size > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(entry)
+        size += entry_size
+    if batch:
+        yield batch
+
+
+def reingest_records(event, records, max_attempts=5):
+    """
+    put records back on the source of the delivery stream, retrying only failed entries
+    """
+    import boto3
+
+    if 'sourceKinesisStreamArn' in event:
+        client = boto3.client('kinesis')
+        stream_name = event['sourceKinesisStreamArn'].split('/')[-1]
+        entries = [{'Data': base64.b64decode(record['data']),
+                    'PartitionKey': record['kinesisRecordMetadata']['partitionKey']} for record in records]
+        # PutRecords takes up to 500 records and 5 MB per call
+        batches = _batches(entries, 500, 5 * 1024 * 1024)
+
+        def put(batch):
+            response = client.put_records(StreamName=stream_name, Records=batch)
+            return response['FailedRecordCount'], response['Records']
     else:
-        return_dict = {k: o}
-    return return_dict
\ No newline at end of file
+        client = boto3.client('firehose')
+        stream_name = event['deliveryStreamArn'].split('/')[-1]
+        entries = [{'Data': base64.b64decode(record['data'])} for record in records]
+        # PutRecordBatch takes up to 500 records and 4 MB per call
+        batches = _batches(entries, 500, 4 * 1024 * 1024)
+
+        def put(batch):
+            response = client.put_record_batch(DeliveryStreamName=stream_name, Records=batch)
+            return response['FailedPutCount'], response['RequestResponses']
+
+    for batch in batches:
+        for attempt in range(1, max_attempts + 1):
+            failed_count, results = put(batch)
+            if not failed_count:
+                break
+            batch = [entry for entry, result in zip(batch, results) if 'ErrorCode' in result]
+            if attempt == max_attempts:
+                raise RuntimeError('could not re-ingest {} records'.format(len(batch)))
+            time.sleep(0.1 * 2 ** attempt)
@@ -1,7 +1,384 @@
+import base64
+import importlib
+import json
+import os
+import random
+import time
+from decimal import Decimal
+from functools import lru_cache
+
+# the module name has a dash in it, it is packaged next to this file
+flatten_json = importlib.import_module('flatten-json')
+
+
+@lru_cache(maxsize=4096)
+def deserialize_number(value: str):
+    """
+    DynamoDB sends numbers as strings. Whole numbers become ints, anything else a Decimal
+    so no precision is lost. Stream batches repeat the same few numbers a lot, hence the cache.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return Decimal(value)
+
+
+def _deserialize_binary(value):
+    # binary attributes arrive base64 encoded in the Lambda event
+    return base64.b64decode(value) if isinstance(value, str) else value
+
+
+def deserialize_value(typed: dict):
+    """
+    convert one DynamoDB typed attribute value, e.g. {'N': '42'}, into a native value
+    """
+    (type_name, value), = typed.items()
+    return _DESERIALIZERS[type_name](value)
+
+
+def deserialize_image(image: dict):
+    """
+    convert a DynamoDB typed attribute map, e.g. a NewImage, into a native dictionary
+    """
+    item = {}
+    for name, typed in image.items():
+        # strings and numbers are the bulk of most items, so skip the dispatch for them
+        if 'S' in typed:
+            item[name] = typed['S']
+        elif 'N' in typed:
+            item[name] = deserialize_number(typed['N'])
+        else:
+            item[name] = deserialize_value(typed)
+    return item
+
+
+_DESERIALIZERS = {
+    'S': str,
+    'N': deserialize_number,
+    'BOOL': bool,
+    'NULL': lambda value: None,
+    'B': _deserialize_binary,
+    'SS': set,
+    'NS': lambda values: {deserialize_number(value) for value in values},
+    'BS': lambda values: {_deserialize_binary(value) for value in values},
+    'L': lambda values: [deserialize_value(value) for value in values],
+    'M': deserialize_image,
+}
+
+
+def to_change(record: dict):
+    """
+    the parts of a DynamoDB stream record a record handler needs, with native values
+    """
+    stream_record = record['dynamodb']
+    return {
+        'eventName': record['eventName'],
+        'sequenceNumber': stream_record['SequenceNumber'],
+        'approximateCreationDateTime': stream_record.get('ApproximateCreationDateTime'),
+        'keys': deserialize_image(stream_record['Keys']),
+        'newImage': deserialize_image(stream_record['NewImage']) if 'NewImage' in stream_record else None,
+        'oldImage': deserialize_image(stream_record['OldImage']) if 'OldImage' in stream_record else None,
+    }
+
+
+def _item_key(keys: dict):
+    return tuple(sorted(keys.items()))
+
+
+def coalesce_changes(changes):
+    """
+    reduce changes to the net change per primary key, in SequenceNumber order. An item
+    inserted and removed within the batch disappears, an insert followed by updates stays an
+    insert of the last image, and anything that existed before the batch ends up as one
+    MODIFY or REMOVE carrying the first OldImage and the last NewImage.
+    :return: the coalesced changes, ordered by the first sequence number of each key. Each one
+    keeps that first sequence number so a failure replays all the changes it stands for.
+    """
+    merged = {}
+    for change in sorted(changes, key=lambda change: int(change['sequenceNumber'])):
+        key = _item_key(change['keys'])
+        if key in merged:
+            merged[key][1] = change
+            merged[key][2] += 1
+        else:
+            merged[key] = [change, change, 1]
+
+    coalesced = []
+    for first, last, count in merged.values():
+        if count == 1:
+            coalesced.append(first)
+            continue
+        existed_before = first['eventName'] != 'INSERT'
+        exists_after = last['eventName'] != 'REMOVE'
+        if not existed_before and not exists_after:
+            continue
+        if not existed_before:
+            event_name = 'INSERT'
+        elif exists_after:
+            event_name = 'MODIFY'
+        else:
+            event_name = 'REMOVE'
+        coalesced.append({
+            'eventName': event_name,
+            'sequenceNumber': first['sequenceNumber'],
+            'approximateCreationDateTime': last['approximateCreationDateTime'],
+            'keys': last['keys'],
+            'newImage': last['newImage'] if exists_after else None,
+            'oldImage': first['oldImage'] if existed_before else None,
+        })
+    return coalesced
+
+
+class SinkError(Exception):
+    """
+    records could not be delivered. sequence_number is the lowest stream sequence number
+    among them, which is where the batch has to be replayed from.
+    """
+
+    def __init__(self, message, sequence_number):
+        super().__init__(message)
+        self.sequence_number = sequence_number
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def change_record(change: dict):
+    """
+    a change as one flat json line, e.g. {"eventName": "MODIFY", "keys.id": "a", "newImage.total": 3, ...}
+    """
+    return (json.dumps(flatten_json.flatten(change), default=_json_default) + '\n').encode('utf-8')
+
+
+class BufferedSink:
+    """
+    buffers change records and writes them with as few batch calls as the service limits
+    allow. A call is made when the buffer is full, when the Lambda is running out of time
+    and on flush(). Only the entries the service reports as failed are retried. Subclasses
+    set the call limits of their service.
+    """
+
+    def __init__(self, client, stream_name, context=None, time_margin_ms=5000, max_attempts=5,
+                 base_backoff=0.1):
+        self.client = client
+        self.stream_name = stream_name
+        self.context = context
+        self.time_margin_ms = time_margin_ms
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.calls = 0
+        self.sent = 0
+        self.retried = 0
+        # (entry, entry size, sequence number of the change it came from)
+        self._buffer = []
+        self._size = 0
+
+    def _entry(self, data, change):
+        raise NotImplementedError
+
+    def _put(self, entries):
+        """
+        :return: the error code for each entry, None for the ones that were written
+        """
+        raise NotImplementedError
+
+    def add_change(self, change: dict):
+        """
+        a record handler for process_records
+        """
+        if self.context is not None and self.context.get_remaining_time_in_millis() < self.time_margin_ms:
+            # send what is done and hand the rest of the batch back to be replayed from this change,
+            # which is checked before it is buffered so it is not delivered twice
+            self.flush()
+            raise SinkError('running out of time', change['sequenceNumber'])
+
+        entry = self._entry(change_record(change), change)
+        size = len(entry['Data']) + len(entry.get('PartitionKey', ''))
+        if size > self.max_record_bytes:
+            raise ValueError('change record of {} bytes is over the {} byte limit'.format(
+                size, self.max_record_bytes))
+        if self._buffer and (len(self._buffer) == self.max_records or self._size + size > self.max_bytes):
+            self.flush()
+        self._buffer.append((entry, size, change['sequenceNumber']))
+        self._size += size
+
+    def flush(self):
+        pending = self._buffer
+        self._buffer, self._size = [], 0
+        for attempt in range(1, self.max_attempts + 1):
+            if not pending:
+                return
+            self.calls += 1
+            try:
+                errors = self._put([entry for entry, _, _ in pending])
+            except Exception as e:
+                # a throttled or rejected call, every entry in it failed
+                print('{} call failed: {!r}'.format(type(self).__name__, e))
+                errors = [e] * len(pending)
+            failed = [item for item, error in zip(pending, errors) if error is not None]
+            self.sent += len(pending) - len(failed)
+            if failed and attempt < self.max_attempts:
+                self.retried += len(failed)
+                time.sleep(self.base_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            pending = failed
+        if pending:
+            raise SinkError('{} records could not be delivered to {}'.format(len(pending), self.stream_name),
+                            min((sequence_number for _, _, sequence_number in pending), key=int))
+
+
+class FirehoseSink(BufferedSink):
+    # PutRecordBatch takes up to 500 records and 4 MB per call, 1000 KB per record
+    max_records = 500
+    max_bytes = 4 * 1024 * 1024
+    max_record_bytes = 1000 * 1024
+
+    def _entry(self, data, change):
+        return {'Data': data}
+
+    def _put(self, entries):
+        response = self.client.put_record_batch(DeliveryStreamName=self.stream_name, Records=entries)
+        return [result.get('ErrorCode') for result in response['RequestResponses']]
+
+
+class KinesisSink(BufferedSink):
+    # PutRecords takes up to 500 records and 5 MB per call, 1 MB per record including the key
+    max_records = 500
+    max_bytes = 5 * 1024 * 1024
+    max_record_bytes = 1024 * 1024
+
+    def _entry(self, data, change):
+        # changes to the same item land on the same shard, in order
+        partition_key = '|'.join(str(value) for _, value in _item_key(change['keys']))[:256]
+        return {'Data': data, 'PartitionKey': partition_key}
+
+    def _put(self, entries):
+        response = self.client.put_records(StreamName=self.stream_name, Records=entries)
+        return [result.get('ErrorCode') for result in response['Records']]
+
+
+class LocalStubClient:
+    """
+    stand-in for the Firehose and Kinesis clients used by the sinks. It checks the call
+    limits, keeps every record it accepted and fails a share of the entries at random.
+    """
+
+    def __init__(self, failure_rate=0.0, seed=0):
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.records = []
+        self.calls = 0
+
+    def _put(self, entries, max_bytes):
+        self.calls += 1
+        if len(entries) > 500:
+            raise ValueError('{} records in one call'.format(len(entries)))
+        size = sum(len(entry['Data']) + len(entry.get('PartitionKey', '')) for entry in entries)
+        if size > max_bytes:
+            raise ValueError('{} bytes in one call'.format(size))
+        results = []
+        for entry in entries:
+            if self.random.random() < self.failure_rate:
+                results.append({'ErrorCode': 'ServiceUnavailableException', 'ErrorMessage': 'stub failure'})
+            else:
+                self.records.append(entry)
+                results.append({'RecordId': str(len(self.records))})
+        return results
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        results = self._put(Records, 4 * 1024 * 1024)
+        return {'FailedPutCount': sum('ErrorCode' in result for result in results), 'RequestResponses': results}
+
+    def put_records(self, StreamName, Records):
+        results = self._put(Records, 5 * 1024 * 1024)
+        return {'FailedRecordCount': sum('ErrorCode' in result for result in results), 'Records': results}
+
+
+def _lowest(*sequence_numbers):
+    return min((number for number in sequence_numbers if number is not None), key=int, default=None)
+
+
+def process_records(records, record_handler, coalesce=False, flush=None):
+    """
+    call record_handler with each change in stream order. Processing stops at the first
+    record that raises: Lambda resumes the shard from the lowest reported sequence number,
+    so anything after it would be replayed anyway.
+    :param coalesce: hand record_handler only the net change per primary key, see coalesce_changes
+    :param flush: called once all changes are handled, e.g. to send what a sink still buffers
+    :return: the partial batch response, naming the failed record if there was one
+    """
+    changes = []
+    failed = None
+    for record in records:
+        try:
+            changes.append(to_change(record))
+        except Exception as e:
+            # changes before an unreadable record can still be processed
+            failed = record['dynamodb']['SequenceNumber']
+            print('record {} could not be read, retrying from there: {!r}'.format(failed, e))
+            break
+
+    if coalesce:
+        received = len(changes)
+        changes = coalesce_changes(changes)
+        print('coalesced {} changes into {}, saving {} downstream operations'.format(
+            received, len(changes), received - len(changes)))
+
+    for change in changes:
+        try:
+            record_handler(change)
+        except Exception as e:
+            # a sink reports the oldest change it could not deliver, which may precede this one
+            failed = _lowest(failed, getattr(e, 'sequence_number', None) or change['sequenceNumber'])
+            print('record {} failed, retrying from there: {!r}'.format(failed, e))
+            break
+
+    if flush is not None:
+        try:
+            flush()
+        except SinkError as e:
+            failed = _lowest(failed, e.sequence_number)
+            print('record {} failed, retrying from there: {!r}'.format(failed, e))
+
+    if failed is None:
+        return {'batchItemFailures': []}
+    return {'batchItemFailures': [{'itemIdentifier': failed}]}
+
+
+def print_change(change):
+    if change['newImage'] is not None:
+        print("New image {}".format(change['newImage']))
+    if change['oldImage'] is not None:
+        print("Old image {}".format(change['oldImage']))
+
+
+def sink_from_environment(context):
+    """
+    a FirehoseSink for DELIVERY_STREAM_NAME or a KinesisSink for KINESIS_STREAM_NAME,
+    None when neither is set
+    """
+    import boto3
+
+    if os.environ.get('DELIVERY_STREAM_NAME'):
+        return FirehoseSink(boto3.client('firehose'), os.environ['DELIVERY_STREAM_NAME'], context)
+    if os.environ.get('KINESIS_STREAM_NAME'):
+        return KinesisSink(boto3.client('kinesis'), os.environ['KINESIS_STREAM_NAME'], context)
+    return None
+
+
 def handler(event, context):
-    for record in event["Records"]:
-        if "NewImage" in record["dynamodb"]:
-            print("New image {}".format(record["dynamodb"]["NewImage"]))
-        if "OldImage" in record["dynamodb"]:
-            print("Old image {}".format(record["dynamodb"]["OldImage"]))
-    return "done"
\ No newline at end of file
+    coalesce = os.environ.get('COALESCE_CHANGES', 'false').lower() == 'true'
+    sink = sink_from_environment(context)
+    if sink is None:
+        return process_records(event["Records"], print_change, coalesce=coalesce)
+
+    response = process_records(event["Records"], sink.add_change, coalesce=coalesce, flush=sink.flush)
+    print('sent {} change records to {} in {} calls, {} retried'.format(
+        sink.sent, sink.stream_name, sink.calls, sink.retried))
+    return response
@@ -1,4 +1,4 @@
-import fs = require('fs');
+import path = require('path');
 import cdk = require('@aws-cdk/core');
 import s3 = require('@aws-cdk/aws-s3');
 import cfn = require('@aws-cdk/aws-cloudformation');
@@ -39,7 +39,12 @@ export class BuildPipeline extends cdk.Construct {
     var sourceAction, buildSpec;
 
     const sourceOutput = new codepipeline.Artifact();
-    const lambdaSource = fs.readFileSync('lambda/build-pipeline-helper.py').toString();
+    // the helper is too large for inline code, so cfnresponse comes from the layer shared with the other custom resources
+    const lambdaCode = lambda.Code.asset('lambda');
+    const cfnResponseLayer = new lambda.LayerVersion(this, 'CfnResponseLayer', {
+      code: lambda.Code.fromAsset(path.join(__dirname, '../../shared/cfnresponse')),
+      compatibleRuntimes: [lambda.Runtime.PYTHON_3_7]
+    });
 
     if ('github' in props) {
       const match = props.github.match(/https:\/\/github.com\/[^\/]+\/([^\/]+)\/archive\/([^\/]+)\.zip/);
@@ -54,9 +59,12 @@ export class BuildPipeline extends cdk.Construct {
 
       const downloadLambda = new lambda.Function(this, 'DownloadLambda', {
         runtime: lambda.Runtime.PYTHON_3_7,
-        timeout: Duration.seconds(30),
-        code: lambda.Code.inline(lambdaSource),
-        handler: 'index.download_sources',
+        // sources are streamed to S3 in parts, so memory does not grow with the archive size
+        timeout: Duration.minutes(5),
+        memorySize: 256,
+        code: lambdaCode,
+        handler: 'build-pipeline-helper.download_sources',
+        layers: [cfnResponseLayer],
         environment: {
           url: props.github,
           bucket: props.bucket.bucketName,
@@ -65,6 +73,8 @@ export class BuildPipeline extends cdk.Construct {
       });
 
       props.bucket.grantPut(downloadLambda);
+      // reads the metadata of the previous copy to make the download conditional
+      props.bucket.grantRead(downloadLambda, key);
 
       new cfn.CustomResource(this, 'DownloadLambdaResource', {
         provider: CustomResourceProvider.lambda(downloadLambda)
@@ -154,9 +164,10 @@ export class BuildPipeline extends cdk.Construct {
 
     const notifyLambda = new lambda.Function(this, 'NotifyLambda', {
       runtime: lambda.Runtime.PYTHON_3_7,
-      code: lambda.Code.inline(lambdaSource),
+      code: lambdaCode,
       timeout: Duration.seconds(10),
-      handler: 'index.notify_build_success',
+      handler: 'build-pipeline-helper.notify_build_success',
+      layers: [cfnResponseLayer],
       environment: {
         waitHandleUrl: waitHandle.ref,
       }
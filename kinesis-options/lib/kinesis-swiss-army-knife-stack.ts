@@ -1,4 +1,3 @@
-import fs = require('fs')
 import cdk = require('@aws-cdk/core');
 import s3 = require('@aws-cdk/aws-s3');
 import iam = require('@aws-cdk/aws-iam');
@@ -89,15 +88,19 @@ export class KinesisSwissArmyKnifeStack extends cdk.Stack {
       }]
     });
 
-    const lambdaSource = fs.readFileSync('lambda/stream-handler.py').toString();
-
     const streamLambda =  new lambda.Function(this, 'EmptyBucketLambda', {
         runtime: lambda.Runtime.PYTHON_3_7,
-        timeout: Duration.seconds(15),
-        code: lambda.Code.inline(lambdaSource),
-        handler: 'index.handler'
+        timeout: Duration.minutes(1),
+        code: lambda.Code.asset('lambda'),
+        handler: 'stream-handler.handler',
+        environment: {
+            // table changes are forwarded as flattened json lines to the raw delivery pipeline
+            KINESIS_STREAM_NAME: stream.streamName
+        }
     });
 
+    stream.grantWrite(streamLambda);
+
     const configTable = new dynamodb.Table(this, "ConfigTable", {
         partitionKey: {name: "id", type: dynamodb.AttributeType.STRING},
         billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
@@ -107,12 +110,17 @@ export class KinesisSwissArmyKnifeStack extends cdk.Stack {
     
     configTable.grantStreamRead(streamLambda);
     
-    streamLambda.addEventSourceMapping("EventSourceMapping", {
+    const streamMapping = streamLambda.addEventSourceMapping("EventSourceMapping", {
         eventSourceArn: configTable.tableStreamArn as string,
         enabled: true,
         startingPosition: lambda.StartingPosition.LATEST
     })
 
+    // the handler returns batchItemFailures so only the failed part of a batch is retried,
+    // this version of the CDK has no property for it yet
+    (streamMapping.node.defaultChild as lambda.CfnEventSourceMapping).addPropertyOverride(
+        'FunctionResponseTypes', ['ReportBatchItemFailures']);
+
     // new NeptuneNotebooks(this, 'NeptuneNotebook', {
     //   vpc: vpcNetwork.vpc
     // })
@@ -5,8 +5,9 @@ import kdf = require('@aws-cdk/aws-kinesisfirehose')
 import logs = require('@aws-cdk/aws-logs');
 import iam = require('@aws-cdk/aws-iam');
 import glue = require('@aws-cdk/aws-glue')
+import lambda = require('@aws-cdk/aws-lambda');
 
-import { RemovalPolicy } from '@aws-cdk/core';
+import { RemovalPolicy, Duration } from '@aws-cdk/core';
 import { RetentionDays } from '@aws-cdk/aws-logs';
 
 export interface DeliveryPipelineProps {
@@ -16,6 +17,7 @@ export interface DeliveryPipelineProps {
   tableName: string,
   curatedColumns: Array<glue.CfnTable.ColumnProperty>
   rawColumns: Array<glue.CfnTable.ColumnProperty>
+  flattenRecords?: boolean
 }
 
 export class S3DeliveryPipeline extends cdk.Construct {
@@ -163,6 +165,38 @@ export class S3DeliveryPipeline extends cdk.Construct {
       }
     });
 
+    var processingConfiguration;
+
+    if (props.flattenRecords) {
+      // flattens nested json records before they are delivered, see lambda/flatten-json.py
+      const flattenLambda = new lambda.Function(this, 'FlattenRecordsLambda', {
+        runtime: lambda.Runtime.PYTHON_3_7,
+        timeout: Duration.minutes(1),
+        memorySize: 1024,
+        code: lambda.Code.asset('lambda'),
+        handler: 'flatten-json.handler'
+      });
+
+      // records that do not fit in the response are put back on the source stream
+      props.stream.grantWrite(flattenLambda);
+
+      firehoseRole.addToPolicy(new iam.PolicyStatement({
+        actions: ['lambda:InvokeFunction', 'lambda:GetFunctionConfiguration'],
+        resources: [flattenLambda.functionArn]
+      }));
+
+      processingConfiguration = {
+        enabled: true,
+        processors: [{
+          type: 'Lambda',
+          parameters: [{
+            parameterName: 'LambdaArn',
+            parameterValue: flattenLambda.functionArn
+          }]
+        }]
+      };
+    }
+
     const firehose = new kdf.CfnDeliveryStream(this, 'DataDeliveryStream', {
       deliveryStreamType: 'KinesisStreamAsSource',
       kinesisStreamSourceConfiguration: {
@@ -182,6 +216,7 @@ export class S3DeliveryPipeline extends cdk.Construct {
           logGroupName: firehoseLogGroup.logGroupName,
           logStreamName: firehoseLogStream.logStreamName
         },
+        processingConfiguration: processingConfiguration,
         s3BackupMode: 'Enabled',
         s3BackupConfiguration: {
           roleArn: firehoseRole.roleArn,
@@ -0,0 +1,40 @@
+import importlib.util
+import io
+import json
+import os
+import time
+
+import pytest
+
+# the lambda file name has a hyphen, so it is loaded from its path
+_spec = importlib.util.spec_from_file_location(
+    'flatten_json', os.path.join(os.path.dirname(__file__), '..', 'lambda', 'flatten-json.py'))
+flatten_json = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(flatten_json)
+
+DOCUMENT = {'id': 'a\\"bé\\\\', 'n': -12.5e3, 'ok': True, 'none': None,
+            'nested': {'list': [1, 'two', {'three': 3}], 'empty': {}}}
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 3, 7, 64, 65536])
+def test_events_do_not_depend_on_the_read_size(read_size):
+    data = json.dumps(DOCUMENT).encode('utf-8')
+    expected = list(flatten_json.json_events(io.BytesIO(data)))
+    assert list(flatten_json.json_events(io.BytesIO(data), read_size)) == expected
+    assert ('map_key', 'id') in expected and ('string', DOCUMENT['id']) in expected
+
+
+@pytest.mark.parametrize('value', ['x' * (4 << 20), 'a\\b"c' * (1 << 20), 10 ** 4000])
+def test_long_token_in_small_chunks(value):
+    data = json.dumps({'value': value}).encode('utf-8')
+    started = time.time()
+    events = list(flatten_json.json_events(io.BytesIO(data), 64))
+    # each chunk of the token is scanned once, rescanning it from its start takes minutes
+    assert time.time() - started < 10
+    assert events[2] == ('string' if isinstance(value, str) else 'number', value)
+
+
+@pytest.mark.parametrize('document', ['{"a": "unterminated', '{"a": tru}', '[1, 2', '{"a" 1}'])
+def test_malformed_document_in_small_chunks(document):
+    with pytest.raises(ValueError):
+        list(flatten_json.json_events(io.StringIO(document), 2))
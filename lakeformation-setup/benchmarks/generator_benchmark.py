@@ -0,0 +1,128 @@
+#!/usr/bin/python
+"""
+compares the scalar and the numpy batch order generators of scripts/generator.py, for
+throughput and for the distributions they produce, and alias table sampling against a
+bisect over cumulative weights
+
+    python benchmarks/generator_benchmark.py [-n <orders>] [-c <chunk size>]
+"""
+
+import bisect
+import getopt
+import itertools
+import random
+import os
+import statistics
+import sys
+import timeit
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import generator
+
+
+def scalar_orders(count):
+    generate_order = generator.make_orders_generator()
+    return [generate_order() for _ in range(count)]
+
+
+def batch_orders(count, chunk_size):
+    generate_orders = generator.make_orders_batch_generator(seed=42)
+    orders = []
+    for start in range(0, count, chunk_size):
+        orders.extend(generate_orders(min(chunk_size, count - start)))
+    return orders
+
+
+def describe(orders):
+    """
+    per category share of orders, mean sku number and mean and deviation of the price
+    """
+    prefixes = {prefix: category for category, prefix in generator.PRODUCT_CATEGORY_SKU_PREFIX.items()}
+    by_category = {}
+    for order in orders:
+        prefix, number = order['sku'].split('-')
+        by_category.setdefault(prefixes[prefix], []).append((int(number) // 9973, order['price']))
+    customers = Counter(order['customer_id'] for order in orders)
+    return {
+        'categories': {category: (len(values) / len(orders),
+                                  statistics.mean(sku for sku, _ in values),
+                                  statistics.mean(price for _, price in values),
+                                  statistics.pstdev(price for _, price in values))
+                       for category, values in sorted(by_category.items())},
+        'customers': {customer: count / len(orders) for customer, count in customers.items()}
+    }
+
+
+def run_sampling(sizes=(5, 100, 1000, 10000, 1000000), draws=200000):
+    print('{} weighted draws'.format(draws))
+    for size in sizes:
+        weights = generator.zipf_weights(size, 1.1)
+        cum_weights = list(itertools.accumulate(weights))
+        total = cum_weights[-1]
+        table = generator.AliasTable(weights)
+
+        def draw_bisect():
+            return [bisect.bisect(cum_weights, random.random() * total) for _ in range(draws)]
+
+        def draw_alias():
+            return [table.sample() for _ in range(draws)]
+
+        baseline = min(timeit.repeat(draw_bisect, number=1, repeat=3))
+        best = min(timeit.repeat(draw_alias, number=1, repeat=3))
+        print('  {:>8} values  bisect {:>10.0f} draws/s  alias {:>10.0f} draws/s  {:>5.2f}x'.format(
+            size, draws / baseline, draws / best, baseline / best))
+
+        # batches of 500 as the batch generator draws them
+        rng = np.random.default_rng(42)
+        p = np.array(weights) / total
+        baseline = min(timeit.repeat(lambda: [rng.choice(size, size=500, p=p) for _ in range(draws // 500)],
+                                     number=1, repeat=3))
+        best = min(timeit.repeat(lambda: [table.sample_many(rng, 500) for _ in range(draws // 500)],
+                                 number=1, repeat=3))
+        print('  {:>8} values  choice {:>10.0f} draws/s  alias {:>10.0f} draws/s  {:>5.2f}x  (numpy)'.format(
+            size, draws / baseline, draws / best, baseline / best))
+
+
+def main(argv):
+    count, chunk_size = 200000, 500
+    try:
+        opts, args = getopt.getopt(argv, "hn:c:", ["orders=", "chunk-size="])
+    except getopt.GetoptError:
+        print('generator_benchmark.py -n <orders> -c <chunk size>')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('generator_benchmark.py -n <orders> -c <chunk size>')
+            sys.exit()
+        elif opt in ("-n", "--orders"):
+            count = int(arg)
+        elif opt in ("-c", "--chunk-size"):
+            chunk_size = int(arg)
+
+    scalar = describe(scalar_orders(count))
+    batch = describe(batch_orders(count, chunk_size))
+    print('{:<32} {:>15} {:>15} {:>19} {:>15}'.format('category', 'share', 'mean sku', 'mean price', 'price std'))
+    for category in scalar['categories']:
+        s, b = scalar['categories'][category], batch['categories'][category]
+        print('{:<32} {:>6.3f} / {:<6.3f} {:>6.2f} / {:<6.2f} {:>8.2f} / {:<8.2f} {:>6.2f} / {:<6.2f}'.format(
+            category, s[0], b[0], s[1], b[1], s[2], b[2], s[3], b[3]))
+    for customer in sorted(scalar['customers'], key=str):
+        print('{:<32} {:>6.3f} / {:<6.3f}'.format(str(customer), scalar['customers'][customer],
+                                                   batch['customers'].get(customer, 0.0)))
+
+    print('{} orders'.format(count))
+    baseline = min(timeit.repeat(lambda: scalar_orders(count), number=1, repeat=3))
+    print('  {:<24} {:>10.0f} orders/s'.format('scalar', count / baseline))
+    for size in sorted({100, chunk_size, 10000}):
+        best = min(timeit.repeat(lambda: batch_orders(count, size), number=1, repeat=3))
+        print('  {:<24} {:>10.0f} orders/s  {:>6.2f}x'.format('batch of {}'.format(size), count / best, baseline / best))
+
+    run_sampling()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,14 +1,18 @@
 import bisect
 import datetime
+import functools
+import itertools
 import json
 import random
+import time
 from time import sleep
 
 import boto3
 from botocore.exceptions import ClientError
-import itertools
-import functools
+import heapq
 import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 PRODUCT_CATEGORY_POPULARITY = {
@@ -52,23 +56,148 @@ CUSTOMERS = {
     'Prime Video': 14
 }
 
+# below this many values a bisect over the cumulative weights, which runs in C, draws faster
+# than the pure Python alias table, whose draw only wins for large populations
+ALIAS_MIN_SIZE = 1000
+
+# PutRecordBatch takes up to 500 records and 4 MB per call
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+
 log = logging.getLogger(__name__)
 
 
-def weighted_choice(values, cum_weights):
+class AliasTable:
+    """
+    Walker alias table over the indexes 0..n-1 of a list of weights: built in O(n), after
+    which every draw takes one uniform index and one coin flip, however many weights there are
+    """
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * n / total for weight in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        # pair each underfull column with an overfull one that tops it up
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, rnd=random):
+        # the integer part picks the column and the fraction is the coin flip
+        u = rnd.random() * len(self.prob)
+        i = int(u)
+        return i if u - i < self.prob[i] else self.alias[i]
+
+    def sample_many(self, rng, size):
+        """
+        :param rng: a numpy random generator
+        :return: a numpy array of size indexes
+        """
+        import numpy as np
+
+        if self._arrays is None:
+            self._arrays = np.array(self.prob), np.array(self.alias, dtype=np.int64)
+        prob, alias = self._arrays
+        i = rng.integers(len(prob), size=size)
+        return np.where(rng.random(size) < prob[i], i, alias[i])
+
+
+def weighted_choice(values, cum_weights, rnd=random):
     total = cum_weights[-1]
-    return values[bisect.bisect(cum_weights, random.random() * total)]
+    return values[bisect.bisect(cum_weights, rnd.random() * total)]
+
+
+class Population:
+    """
+    weighted values to draw from, either listed or named on demand from their index so
+    populations of millions do not have to be held as strings. Single draws bisect the
+    cumulative weights of small populations and use the alias table of large ones, batches
+    always use the alias table.
+    """
+
+    def __init__(self, weights, values=None, name=str):
+        self.table = AliasTable(weights)
+        self.values = values
+        self.name = name
+        self.cum_weights = list(itertools.accumulate(weights)) if len(weights) < ALIAS_MIN_SIZE else None
+
+    def value(self, index):
+        return self.values[index] if self.values is not None else self.name(index)
+
+    def sample(self, rnd=random):
+        if self.cum_weights is not None:
+            total = self.cum_weights[-1]
+            return self.value(bisect.bisect(self.cum_weights, rnd.random() * total))
+        return self.value(self.table.sample(rnd))
+
+    def sample_indexes(self, rng, size):
+        return self.table.sample_many(rng, size)
+
+    def sample_many(self, rng, size):
+        return [self.value(i) for i in self.sample_indexes(rng, size).tolist()]
+
+
+def weighted_population(weight_dict):
+    values, weights = zip(*weight_dict.items())
+    return Population(weights, list(values))
+
+
+def zipf_weights(size, exponent=1.0):
+    """
+    power law weights, the item of rank r being drawn in proportion to 1 / r ** exponent
+    """
+    return [1.0 / rank ** exponent for rank in range(1, size + 1)]
+
+
+def customer_name(index):
+    # customer-0000001 is the hottest key of a generated population
+    return 'customer-{:07d}'.format(index + 1)
+
+
+def sku_number(index):
+    # the same numbering as the exponentially distributed SKUs
+    return (index + 1) * 9973
+
+
+def load_population(spec, name=customer_name):
+    """
+    :param spec: 'zipf:<size>:<exponent>' to generate a power law population of size values
+    named by name(rank - 1), or the path of a json file mapping each value to its weight
+    """
+    if spec.startswith('zipf:'):
+        _, size, exponent = spec.split(':')
+        return Population(zipf_weights(int(size), float(exponent)), name=name)
+    with open(spec) as population_file:
+        return weighted_population(json.load(population_file))
 
 
 def make_weighted_generator(weight_dict):
+    if len(weight_dict) >= ALIAS_MIN_SIZE:
+        return weighted_population(weight_dict).sample
     elements, weights = zip(*weight_dict.items())
     cum_weights = list(itertools.accumulate(weights))
     return functools.partial(weighted_choice, elements, cum_weights)
 
 
-def generate_sku(product_category):
-    scale = PRODUCT_CATEGORY_SKU_EXP_DISTRIBUTION[product_category]
+def generate_sku(product_category, skus=None):
+    """
+    :param skus: a Population of SKU numbers, by default they are exponentially distributed
+    """
     prefix = PRODUCT_CATEGORY_SKU_PREFIX[product_category]
+    if skus is not None:
+        return '{}-{}'.format(prefix, skus.sample())
+    scale = PRODUCT_CATEGORY_SKU_EXP_DISTRIBUTION[product_category]
     num = (1 + round(random.expovariate(scale))) * 9973
     return '{}-{}'.format(prefix, num)
 
@@ -78,7 +207,11 @@ def generate_price(product_category):
     return random.normalvariate(dist_data['mean'], dist_data['std'])
 
 
-def make_orders_generator():
+def make_orders_generator(customers=None, skus=None):
+    """
+    :param customers: a Population of customer ids, CUSTOMERS by default
+    :param skus: a Population of SKU numbers shared by all categories, see generate_sku
+    """
 
     def generate_order():
         customer_id = generate_customer_id() if random.random() > 0.05 else None
@@ -87,34 +220,341 @@ def make_orders_generator():
             'order_date': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         }
         product_category = generate_product_category()
-        order['sku'] = generate_sku(product_category)
+        order['sku'] = generate_sku(product_category, skus)
         order['price'] = generate_price(product_category)
         return order
 
-    # with open(customers_data_path) as customers_file:
-    #     customer_to_weight = json.load(customers_file)
     generate_product_category = make_weighted_generator(PRODUCT_CATEGORY_POPULARITY)
-    generate_customer_id = make_weighted_generator(CUSTOMERS)
+    generate_customer_id = customers.sample if customers is not None else make_weighted_generator(CUSTOMERS)
 
     return generate_order
 
 
-def generate_data_to_kinesis(config):
-    firehose_client = boto3.client('firehose')
-    generate_order = make_orders_generator()
-    sleep_interval = float(config['generator_sleep_interval'])
-    chunk_size = int(config['generator_chunk_size'])
-    for _ in range(int(config['generator_events_count']) // chunk_size):
-        sleep(sleep_interval)
-        records = [{'Data': json.dumps(generate_order()) + '\n'} for _ in range(chunk_size)]
+def make_orders_batch_generator(seed=None, customers=None, skus=None):
+    """
+    vectorized version of make_orders_generator with the same distributions, for load
+    tests that need more orders per second than the scalar path can produce
+    :param seed: seed for the numpy random generator, for reproducible runs
+    :param customers: a Population of customer ids, CUSTOMERS by default
+    :param skus: a Population of SKU numbers shared by all categories, see generate_sku
+    :return: a function that takes a number of orders and returns a list of them
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+
+    categories = list(PRODUCT_CATEGORY_POPULARITY)
+    category_population = Population([PRODUCT_CATEGORY_POPULARITY[c] for c in categories])
+    sku_prefixes = np.array([PRODUCT_CATEGORY_SKU_PREFIX[c] for c in categories])
+    sku_rates = np.array([PRODUCT_CATEGORY_SKU_EXP_DISTRIBUTION[c] for c in categories])
+    price_means = np.array([PRODUCT_CATEGORY_PRICE_DISTRIBUTIONS[c]['mean'] for c in categories], dtype=float)
+    price_stds = np.array([PRODUCT_CATEGORY_PRICE_DISTRIBUTIONS[c]['std'] for c in categories], dtype=float)
+
+    customers = customers or weighted_population(CUSTOMERS)
+
+    # every order created within the same second shares one formatted timestamp
+    order_date = {'second': None, 'value': None}
+
+    def current_order_date():
+        second = int(time.time())
+        if second != order_date['second']:
+            order_date['second'] = second
+            order_date['value'] = datetime.datetime.utcfromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+        return order_date['value']
+
+    def generate_orders(chunk_size):
+        category = category_population.sample_indexes(rng, chunk_size)
+        if skus is None:
+            # random.expovariate(rate) has mean 1 / rate
+            sku_ranks = np.round(rng.exponential(size=chunk_size) / sku_rates[category]).astype(np.int64)
+            sku_numbers = ((1 + sku_ranks) * 9973).tolist()
+        else:
+            sku_numbers = skus.sample_many(rng, chunk_size)
+        prices = price_means[category] + price_stds[category] * rng.standard_normal(chunk_size)
+        customer = customers.sample_indexes(rng, chunk_size)
+        has_customer = rng.random(chunk_size) > 0.05
+
+        stamp = current_order_date()
+        return [
+            {'customer_id': customers.value(c) if known else None, 'order_date': stamp,
+             'sku': '{}-{}'.format(prefix, number), 'price': price}
+            for c, known, prefix, number, price in zip(customer.tolist(), has_customer.tolist(),
+                                                       sku_prefixes[category].tolist(), sku_numbers,
+                                                       prices.tolist())
+        ]
+
+    return generate_orders
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+
+class FirehoseSender:
+    """
+    sends records to a delivery stream at a target rate, with several put_record_batch calls
+    in flight. Records reported as failed are queued to go out again with a later batch after
+    a backoff, the rest of their batch is not sent again.
+    """
+
+    def __init__(self, client, stream_name, target_rate=None, max_in_flight=4, max_attempts=5, base_backoff=0.1):
+        """
+        :param target_rate: records per second to aim for, resent records included. None sends
+        as fast as possible.
+        """
+        self.client = client
+        self.stream_name = stream_name
+        self.target_rate = target_rate
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.calls = 0
+        self.latencies_ms = []
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        # (time it may be sent again, tie breaker, attempt, record)
+        self._retries = []
+        self._outstanding = 0
+        self._carried = None
+
+    def _next_batch(self, records, max_records):
+        """
+        :return: (batch of (record, attempt) pairs, whether records is exhausted)
+        """
+        batch, size = [], 0
+        now = time.monotonic()
+        with self._lock:
+            while (self._retries and self._retries[0][0] <= now and len(batch) < max_records
+                   and size + len(self._retries[0][3]['Data']) <= MAX_BATCH_BYTES):
+                _, _, attempt, record = heapq.heappop(self._retries)
+                batch.append((record, attempt))
+                size += len(record['Data'])
+        while len(batch) < max_records:
+            # a record that did not fit in the previous batch goes first
+            record, self._carried = self._carried or next(records, None), None
+            if record is None:
+                return batch, True
+            if batch and size + len(record['Data']) > MAX_BATCH_BYTES:
+                self._carried = record
+                break
+            batch.append((record, 1))
+            size += len(record['Data'])
+        return batch, False
+
+    def send(self, records):
+        """
+        send every record, starting each batch when the target rate allows it
+        :param records: an iterable of {'Data': ...} records, consumed as it is sent
+        :return: the stats of the run
+        """
+        records = iter(records)
+        max_records = MAX_BATCH_RECORDS
+        if self.target_rate:
+            # at low rates several smaller calls a second give a smoother load than one big one
+            max_records = max(1, min(MAX_BATCH_RECORDS, int(self.target_rate / 10)))
+
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        started = time.monotonic()
+        exhausted = False
+        futures = []
+
+        def done(_):
+            with self._lock:
+                self._outstanding -= 1
+            in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            while True:
+                batch, exhausted = self._next_batch(records, max_records)
+                if not batch:
+                    with self._lock:
+                        if exhausted and not self._outstanding and not self._retries:
+                            break
+                    # waiting on batches in flight or on the backoff of failed records
+                    sleep(0.01)
+                    continue
+                if self.target_rate:
+                    delay = started + self.submitted / self.target_rate - time.monotonic()
+                    if delay > 0:
+                        sleep(delay)
+                in_flight.acquire()
+                with self._lock:
+                    self._outstanding += 1
+                future = pool.submit(self._put, batch)
+                future.add_done_callback(done)
+                futures.append(future)
+                self.submitted += len(batch)
+        for future in futures:
+            future.result()
+        self.elapsed = time.monotonic() - started
+        return self.stats()
+
+    def _put(self, batch):
+        call_started = time.monotonic()
         try:
-            print(records)
-            # firehose_client.put_record_batch(
-            #     DeliveryStreamName=config['orders_stream_name'],
-            #     Records=records
-            # )
+            response = self.client.put_record_batch(DeliveryStreamName=self.stream_name,
+                                                    Records=[record for record, _ in batch])
+            failed = [item for item, result in zip(batch, response['RequestResponses']) if 'ErrorCode' in result]
         except ClientError as e:
             log.error(e.response)
+            failed = batch
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            self.latencies_ms.append((now - call_started) * 1000)
+            self.sent += len(batch) - len(failed)
+            for record, attempt in failed:
+                if attempt < self.max_attempts:
+                    self.retried += 1
+                    backoff = self.base_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    heapq.heappush(self._retries, (now + backoff, id(record), attempt + 1, record))
+                else:
+                    self.failed += 1
+                    log.error('gave up on a record after %d attempts', attempt)
+
+    def stats(self):
+        return {
+            'target_rate': self.target_rate,
+            'elapsed': self.elapsed,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'calls': self.calls,
+            'latencies_ms': list(self.latencies_ms),
+        }
+
+
+def print_stats(stats):
+    achieved = stats['sent'] / max(stats['elapsed'], 1e-6)
+    target = 'as fast as possible'
+    if stats['target_rate']:
+        target = '{:.0f} events/s target ({:.0%})'.format(stats['target_rate'], achieved / stats['target_rate'])
+    print('sent {} events in {:.1f}s: {:.0f} events/s vs {}'.format(stats['sent'], stats['elapsed'], achieved, target))
+    print('{} put_record_batch calls, p50 {:.1f} ms, p99 {:.1f} ms, {} records retried, {} failed'.format(
+        stats['calls'], percentile(stats['latencies_ms'], 50), percentile(stats['latencies_ms'], 99),
+        stats['retried'], stats['failed']))
+
+
+class StubFirehoseClient:
+    """
+    stand-in for the Firehose client that checks the call limits, takes latency_ms per call
+    and fails a share of the records at random
+    """
+
+    def __init__(self, latency_ms=20, failure_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.records = 0
+        self._lock = threading.Lock()
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        if len(Records) > MAX_BATCH_RECORDS:
+            raise ValueError('{} records in one call'.format(len(Records)))
+        if sum(len(record['Data']) for record in Records) > MAX_BATCH_BYTES:
+            raise ValueError('more than {} bytes in one call'.format(MAX_BATCH_BYTES))
+        sleep(self.latency_ms / 1000.0)
+        with self._lock:
+            results = [{'ErrorCode': 'ServiceUnavailableException'} if self.random.random() < self.failure_rate
+                       else {'RecordId': str(i)} for i in range(len(Records))]
+            self.records += sum('RecordId' in result for result in results)
+        return {'FailedPutCount': sum('ErrorCode' in result for result in results), 'RequestResponses': results}
+
+
+def target_rate_from_config(config):
+    if config.get('generator_target_rate'):
+        return float(config['generator_target_rate'])
+    # the rate the generator used to reach by sleeping between chunks
+    return int(config['generator_chunk_size']) / float(config['generator_sleep_interval'])
+
+
+def send_orders(config, firehose_client, events_count, target_rate, seed=None):
+    """
+    generate events_count orders and send them at target_rate
+    :return: the stats of the run
+    """
+    customers = load_population(config['generator_customers']) if config.get('generator_customers') else None
+    skus = load_population(config['generator_skus'], sku_number) if config.get('generator_skus') else None
+    generate_orders = make_orders_batch_generator(seed, customers, skus)
+    chunk_size = int(config['generator_chunk_size'])
+
+    def records():
+        for start in range(0, events_count, chunk_size):
+            for order in generate_orders(min(chunk_size, events_count - start)):
+                yield {'Data': (json.dumps(order) + '\n').encode('utf-8')}
+
+    sender = FirehoseSender(firehose_client, config['orders_stream_name'], target_rate=target_rate,
+                            max_in_flight=int(config.get('generator_max_in_flight', '4')))
+    return sender.send(records())
+
+
+def generate_data_to_kinesis(config, firehose_client=None, seed=None):
+    """
+    :param firehose_client: the client to send with, a boto3 Firehose client by default
+    :return: the stats of the run
+    """
+    firehose_client = firehose_client or boto3.client('firehose')
+    stats = send_orders(config, firehose_client, int(config['generator_events_count']),
+                        target_rate_from_config(config), seed)
+    print_stats(stats)
+    return stats
+
+
+def _worker(config, worker, events_count, target_rate, seed):
+    # clients cannot be shared between processes, each worker makes its own
+    if config['orders_stream_name']:
+        client = boto3.client('firehose')
+    else:
+        client = StubFirehoseClient(seed=hash((seed, worker)))
+    worker_seed = None if seed is None else [seed, worker]
+    return send_orders(config, client, events_count, target_rate, worker_seed)
+
+
+def merge_stats(stats_list):
+    """
+    combine the stats of workers that ran at the same time
+    """
+    merged = {
+        'target_rate': sum(stats['target_rate'] or 0 for stats in stats_list) or None,
+        'elapsed': max(stats['elapsed'] for stats in stats_list),
+        'latencies_ms': [latency for stats in stats_list for latency in stats['latencies_ms']],
+    }
+    for name in ('sent', 'failed', 'retried', 'calls'):
+        merged[name] = sum(stats[name] for stats in stats_list)
+    return merged
+
+
+def generate_data_multiprocess(config, processes, seed=None):
+    """
+    split the events and the target rate evenly across worker processes. With a seed every
+    worker generates the same orders on every run.
+    :return: the merged stats of all workers
+    """
+    events_count = int(config['generator_events_count'])
+    target_rate = target_rate_from_config(config)
+    shares = [events_count // processes + (1 if worker < events_count % processes else 0)
+              for worker in range(processes)]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_worker, config, worker, share, target_rate / processes, seed)
+                   for worker, share in enumerate(shares)]
+        stats_list = [future.result() for future in futures]
+
+    for worker, stats in enumerate(stats_list):
+        print('worker {}: {} events at {:.0f} events/s'.format(worker, stats['sent'],
+                                                             stats['sent'] / max(stats['elapsed'], 1e-6)))
+    stats = merge_stats(stats_list)
+    print_stats(stats)
+    return stats
+
 
 if __name__ == "__main__":
     config = {
@@ -125,7 +565,22 @@ if __name__ == "__main__":
         "top_sku_stream_arn": "",
         "kinesis_analytics_role_arn": "",
         "generator_sleep_interval": "0.1",
-        "generator_chunk_size": "15",
-        "generator_events_count": "10000"
+        "generator_target_rate": "1000",
+        "generator_max_in_flight": "4",
+        "generator_chunk_size": "500",
+        "generator_events_count": "10000",
+        "generator_processes": "1",
+        "generator_seed": "42",
+        # e.g. zipf:1000000:1.1 or a json file of customer weights, empty for CUSTOMERS
+        "generator_customers": "",
+        # e.g. zipf:100000:1.2 or a json file of SKU number weights, empty for exponential SKUs
+        "generator_skus": ""
     }
-    generate_data_to_kinesis(config)
\ No newline at end of file
+    processes = int(config['generator_processes'])
+    seed = int(config['generator_seed']) if config['generator_seed'] else None
+    if processes > 1:
+        generate_data_multiprocess(config, processes, seed)
+    else:
+        # without a delivery stream the orders go to a local stub
+        client = None if config['orders_stream_name'] else StubFirehoseClient()
+        generate_data_to_kinesis(config, client, seed)
@@ -1,62 +1,329 @@
 from __future__ import print_function
-import datetime
+import os
 import json
-import boto3
-
-
-# Creates an interactive pyspark spark session. 
-# Python(kind=pyspark), R(kind=sparkr) and SQL(kind=sql) spark sessions can also be created by changing the value of kind.
-def create_spark_session(master_dns, kind='pyspark'):
-    # 8998 is the port on which the Livy server runs
-    host = 'http://' + master_dns + ':8998'
-    data = {'kind': kind}
-    headers = {'Content-Type': 'application/json'}
-    response = requests.post(host + '/sessions', data=json.dumps(data), headers=headers)
-    logging.info(response.json())
-    return response.headers
-
-# Submits the scala code as a simple JSON command to the Livy server
-def submit_statement(session_url, statement_path):
-    statements_url = session_url + '/statements'
-    with open(statement_path, 'r') as f:
-        code = f.read()
-    data = {'code': code}
-    response = requests.post(statements_url, data=json.dumps(data), headers={'Content-Type': 'application/json'})
-    logging.info(response.json())
-    return response
-
-# Function to help track the progress of the scala code submitted to Apache Livy
-def track_statement_progress(master_dns, response_headers):
-    statement_status = ''
-    host = 'http://' + master_dns + ':8998'
-    session_url = host + response_headers['location'].split('/statements', 1)[0]
-    # Poll the status of the submitted scala code
-    while statement_status != 'available':
-            # If a statement takes longer than a few milliseconds to execute, Livy returns early and provides a statement URL that can be polled until it is complete:
-            statement_url = host + response_headers['location']
-            statement_response = requests.get(statement_url, headers={'Content-Type': 'application/json'})
-            statement_status = statement_response.json()['state']
-            logging.info('Statement status: ' + statement_status)
-
-            #logging the logs
-            lines = requests.get(session_url + '/log', headers={'Content-Type': 'application/json'}).json()['log']
-            for line in lines:
-                logging.info(line)
-
-            if 'progress' in statement_response.json():
-                logging.info('Progress: ' + str(statement_response.json()['progress']))
-            time.sleep(10)
-    final_statement_status = statement_response.json()['output']['status']
-    if final_statement_status == 'error':
-        logging.info('Statement exception: ' + statement_response.json()['output']['evalue'])
-        for trace in statement_response.json()['output']['traceback']:
-            logging.info(trace)
-        raise ValueError('Final Statement Status: ' + final_statement_status)
-    logging.info('Final Statement Status: ' + final_statement_status)
+import time
+import uuid
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# 8998 is the port on which the Livy server runs
+LIVY_PORT = 8998
+# poll every 100ms at first and back off to every 10s for long statements
+POLL_INITIAL = 0.1
+POLL_FACTOR = 1.5
+POLL_MAX = 10
+# log lines to fetch per request when tailing a session log
+LOG_PAGE_SIZE = 500
+# the last logged lines kept per session to find the new ones once the log buffer is full
+LOG_TAIL_LINES = 20
+# the logged lines asked for again with each poll, to tell new lines from a rotated buffer
+LOG_ANCHOR_LINES = 3
+REQUEST_TIMEOUT = 30
+SESSION_FAILED_STATES = ('shutting_down', 'error', 'dead', 'killed', 'success')
+STATEMENT_FAILED_STATES = ('error', 'cancelling', 'cancelled')
+STATEMENT_PATH = '/root/airflow/dags/transform/movies.scala'
+# pooled sessions idle for longer than this are deleted
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '900'))
+SESSION_PAGE_SIZE = 100
+
+
+def poll_delays(initial=POLL_INITIAL, factor=POLL_FACTOR, maximum=POLL_MAX):
+    """
+    the delays between polls, short while a statement is likely to finish soon and
+    growing for the ones that run long
+    """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+class LivyClient:
+    """
+    talks to the Livy REST api of an EMR master over one pooled keep-alive session, and
+    remembers how much of each session log it has already logged
+    """
+
+    def __init__(self, master_dns, port=LIVY_PORT, pool_size=4, timeout=REQUEST_TIMEOUT):
+        self.url = 'http://{}:{}'.format(master_dns, port)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        # only idempotent requests are retried, a retried POST could start a second session
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        # per session the log buffer length when last read and the last lines logged
+        self.log_positions = {}
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(method, self.url + path, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    # Creates an interactive pyspark spark session.
+    # Python(kind=pyspark), R(kind=sparkr) and SQL(kind=sql) spark sessions can also be created by changing the value of kind.
+    def create_session(self, kind='pyspark', **properties):
+        session = self._request('POST', '/sessions', data=json.dumps(dict(properties, kind=kind)))
+        logger.info('Created session %s (%s)', session['id'], session['state'])
+        return session
+
+    def get_session(self, session_id):
+        return self._request('GET', '/sessions/{}'.format(session_id))
+
+    def list_sessions(self):
+        sessions = []
+        while True:
+            page = self._request('GET', '/sessions', params={'from': len(sessions), 'size': SESSION_PAGE_SIZE})
+            sessions.extend(page['sessions'])
+            if not page['sessions'] or len(sessions) >= page['total']:
+                return sessions
+
+    def delete_session(self, session_id):
+        self.log_positions.pop(session_id, None)
+        return self._request('DELETE', '/sessions/{}'.format(session_id))
+
+    def wait_for_idle_session(self, session_id, timeout=None):
+        """
+        :return: the session once it is idle
+        """
+        deadline = timeout and time.time() + timeout
+        for delay in poll_delays():
+            session = self.get_session(session_id)
+            if session['state'] == 'idle':
+                return session
+            if session['state'] in SESSION_FAILED_STATES:
+                self.tail_log(session_id)
+                raise ValueError('Session {} is {}'.format(session_id, session['state']))
+            if deadline and time.time() + delay > deadline:
+                raise TimeoutError('Session {} is still {} after {}s'.format(session_id, session['state'], timeout))
+            time.sleep(delay)
+
+    # Submits the code as a simple JSON command to the Livy server
+    def submit_statement(self, session_id, code, kind=None):
+        data = {'code': code}
+        if kind:
+            data['kind'] = kind
+        statement = self._request('POST', '/sessions/{}/statements'.format(session_id), data=json.dumps(data))
+        logger.info('Submitted statement %s (%s)', statement['id'], statement['state'])
+        return statement
+
+    def get_statement(self, session_id, statement_id):
+        return self._request('GET', '/sessions/{}/statements/{}'.format(session_id, statement_id))
+
+    def list_statements(self, session_id):
+        return self._request('GET', '/sessions/{}/statements'.format(session_id))['statements']
+
+    def _read_log(self, session_id, start):
+        """
+        :return: the lines of the session log buffer from start to its end, and its length
+        """
+        lines = []
+        while True:
+            page = self._request('GET', '/sessions/{}/log'.format(session_id),
+                                 params={'from': start + len(lines), 'size': LOG_PAGE_SIZE})
+            lines.extend(page['log'])
+            if not page['log'] or start + len(lines) >= page['total']:
+                return lines, page['total']
+
+    def tail_log(self, session_id):
+        """
+        log the lines the session log gained since the last call. Livy only keeps the last
+        livy.cache-log.size lines (200 by default), so once its buffer is full the total stops
+        growing and old lines drop out at the front. Each call reads again from the last few
+        lines already logged, and when those are no longer where they were the whole buffer is
+        read and lined up with them.
+        :return: the number of new lines
+        """
+        offset, tail = self.log_positions.get(session_id, (0, []))
+        anchor = min(offset, len(tail), LOG_ANCHOR_LINES)
+        lines, total = self._read_log(session_id, offset - anchor)
+        if lines[:anchor] == tail[len(tail) - anchor:]:
+            new = lines[anchor:]
+        else:
+            lines, total = self._read_log(session_id, 0)
+            new = _lines_after(lines, tail)
+
+        for line in new:
+            logger.info(line)
+        self.log_positions[session_id] = (total, (tail + new)[-LOG_TAIL_LINES:])
+        return len(new)
+
+    # Tracks the progress of a statement until it completes, logging the new session log lines on the way
+    def wait_for_statement(self, session_id, statement, timeout=None):
+        """
+        :param statement: the statement as returned by submit_statement
+        :return: the output of the statement
+        :raises ValueError: if the statement failed
+        """
+        deadline = timeout and time.time() + timeout
+        delays = poll_delays()
+        # If a statement takes longer than a few milliseconds to execute, Livy returns early and provides a statement URL that can be polled until it is complete
+        while statement['state'] != 'available':
+            if statement['state'] in STATEMENT_FAILED_STATES:
+                raise ValueError('Statement {} is {}'.format(statement['id'], statement['state']))
+            delay = next(delays)
+            if deadline and time.time() + delay > deadline:
+                raise TimeoutError('Statement {} is still {} after {}s'.format(statement['id'], statement['state'], timeout))
+            time.sleep(delay)
+            statement = self.get_statement(session_id, statement['id'])
+            self.tail_log(session_id)
+            logger.info('Statement status: %s, progress: %s', statement['state'], statement.get('progress'))
+
+        output = statement['output']
+        if output['status'] == 'error':
+            logger.info('Statement exception: %s', output['evalue'])
+            for trace in output['traceback']:
+                logger.info(trace)
+            raise ValueError('Final Statement Status: ' + output['status'])
+        logger.info('Final Statement Status: %s', output['status'])
+        return output
+
+    def run_statement(self, session_id, code, kind=None, timeout=None):
+        statement = self.submit_statement(session_id, code, kind)
+        return self.wait_for_statement(session_id, statement, timeout)
+
+
+def _lines_after(lines, tail):
+    """
+    :return: the lines of a rotated log buffer that follow the last occurrence of the lines
+        logged before, all of them when none of those are left
+    """
+    if not tail:
+        return lines
+    for end in range(len(lines), 0, -1):
+        n = min(end, len(tail))
+        if lines[end - n:end] == tail[len(tail) - n:]:
+            return lines[end:]
+    logger.info('Session log lines were dropped from the Livy log buffer before they could be read')
+    return lines
+
+
+class LivySessionPool:
+    """
+    reuses idle sessions of one kind and tag instead of starting a Spark application for every
+    invocation. Pool sessions are found by their name, so any invocation can use a session another
+    one started. Two invocations can pick the same session, Livy then runs their statements one
+    after the other. Session names need Livy 0.7 or later (EMR 5.30.0 or later), and carry the
+    time the session was started so any invocation can tell how long an unused one has been idle.
+    """
+
+    def __init__(self, client, kind='pyspark', tag='default', ttl=SESSION_TTL, **properties):
+        self.client = client
+        self.kind = kind
+        self.prefix = 'pool-{}-'.format(tag)
+        self.ttl = ttl
+        self.properties = properties
+        # when sessions without statements and a start time in their name were first seen
+        self.first_seen = {}
+
+    def last_active(self, session):
+        """
+        :return: the epoch seconds the session last ran a statement, or was started or first seen
+        """
+        times = [statement.get(field) or 0 for statement in self.client.list_statements(session['id'])
+                 for field in ('started', 'completed')]
+        if any(times):
+            return max(times) / 1000
+        # Livy does not say when a session was created, the pool puts it in the name
+        started = session['name'][len(self.prefix):].split('-')[0]
+        if started.isdigit():
+            return int(started)
+        return self.first_seen.setdefault(session['id'], time.time())
+
+    def sessions(self):
+        return [session for session in self.client.list_sessions()
+                if (session.get('name') or '').startswith(self.prefix) and session['kind'] == self.kind]
+
+    def reap(self, sessions):
+        """
+        delete the idle sessions that have not been used within the ttl, and the failed ones
+        :return: the sessions that are left
+        """
+        left = []
+        now = time.time()
+        for session in sessions:
+            if session['state'] == 'idle':
+                session['lastActive'] = self.last_active(session)
+            if session['state'] in SESSION_FAILED_STATES or now - session.get('lastActive', now) > self.ttl:
+                logger.info('Deleting %s session %s', session['state'], session['id'])
+                try:
+                    self.client.delete_session(session['id'])
+                except requests.HTTPError as e:
+                    # another invocation deleted it first
+                    if e.response.status_code != 404:
+                        raise
+                self.first_seen.pop(session['id'], None)
+            else:
+                left.append(session)
+        return left
+
+    def acquire(self, timeout=None):
+        """
+        :return: an idle pool session, started only when there is none to reuse
+        """
+        idle = [session for session in self.reap(self.sessions()) if session['state'] == 'idle']
+        if idle:
+            # the most recently used session, so the others can age out
+            session = max(idle, key=lambda session: session['lastActive'])
+            logger.info('Reusing session %s', session['id'])
+            return session
+
+        name = '{}{:d}-{}'.format(self.prefix, int(time.time()), uuid.uuid4().hex[:8])
+        session = self.client.create_session(self.kind, name=name, **self.properties)
+        if session.get('name') != name:
+            # an older Livy drops the name, every invocation would then start a session of its own
+            self.client.delete_session(session['id'])
+            raise ValueError('Livy did not keep the session name, the session pool needs Livy 0.7 or later')
+        return self.client.wait_for_idle_session(session['id'], timeout)
+
+
+# one client per master and one pool per kind and tag, so warm invocations keep their connections
+_clients = {}
+_pools = {}
+
+
+def livy_client(master_dns):
+    if master_dns not in _clients:
+        _clients[master_dns] = LivyClient(master_dns)
+    return _clients[master_dns]
+
+
+def session_pool(master_dns, kind, tag):
+    if (master_dns, kind, tag) not in _pools:
+        _pools[(master_dns, kind, tag)] = LivySessionPool(livy_client(master_dns), kind, tag)
+    return _pools[(master_dns, kind, tag)]
+
 
 def handler(event, context):
-    headers = emr.create_spark_session(cluster_dns, 'pyspark')
-    session_url = emr.wait_for_idle_session(cluster_dns, headers)
-    statement_response = emr.submit_statement(session_url,
-                                                '/root/airflow/dags/transform/movies.scala')
-    emr.track_statement_progress(cluster_dns, statement_response.headers)    
\ No newline at end of file
+    # leave a few seconds to report a statement that is still running
+    timeout = context.get_remaining_time_in_millis() / 1000 - 5 if context else None
+    master_dns = event.get('master_dns') or os.environ['MASTER_DNS']
+    client = livy_client(master_dns)
+    kind = event.get('kind', 'pyspark')
+    if event.get('reap'):
+        # run on a schedule, so idle pool sessions are deleted even when no statement comes to reuse them
+        pool = session_pool(master_dns, kind, event.get('tag', 'default'))
+        sessions = pool.sessions()
+        left = pool.reap(sessions)
+        return {'deleted': len(sessions) - len(left), 'left': len(left)}
+    if event.get('pool', os.environ.get('SESSION_POOL') == 'true'):
+        # skip the Spark startup when a warm session is available
+        session = session_pool(master_dns, kind, event.get('tag', 'default')).acquire(timeout)
+    else:
+        session = client.create_session(kind)
+        session = client.wait_for_idle_session(session['id'], timeout)
+
+    code = event.get('code')
+    if code is None:
+        with open(event.get('statement_path', STATEMENT_PATH), 'r') as f:
+            code = f.read()
+    if timeout:
+        timeout = context.get_remaining_time_in_millis() / 1000 - 5
+    output = client.run_statement(session['id'], code, event.get('statement_kind'), timeout)
+    return {'sessionId': session['id'], 'output': output}
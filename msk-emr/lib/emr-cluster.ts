@@ -59,7 +59,8 @@ export class EMRCluster extends cdk.Construct {
         ec2SubnetId: props.vpc.publicSubnets[0].subnetId
       },
       serviceRole: 'EMR_DefaultRole',
-      releaseLabel: 'emr-5.29.0',
+      // Livy 0.7 or later, the session pool of lambda/livy-handler finds its sessions by name
+      releaseLabel: 'emr-5.30.1',
       visibleToAllUsers: true,
       jobFlowRole: profile.ref,
       configurations: [
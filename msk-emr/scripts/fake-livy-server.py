@@ -0,0 +1,243 @@
+#!/usr/bin/python
+"""
+a local stand in for the Livy REST api of an EMR master, to run lambda/livy-handler against
+without a cluster. Sessions take a while to start, statements run for a while and write
+log lines while they do, and a statement containing `raise` fails. Like Livy, only the last
+lines of each session log are kept (livy.cache-log.size, 200 by default).
+
+    python scripts/fake-livy-server.py [-p <port>] [-s <startup seconds>] [-d <statement seconds>]
+        [-l <log lines per second>] [-b <log buffer lines>]
+
+A statement can set its own run time with a `# seconds: <n>` comment.
+"""
+
+import getopt
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+STARTUP_SECONDS = 2
+STATEMENT_SECONDS = 1
+LOG_LINES_PER_SECOND = 200
+LOG_BUFFER_LINES = 200
+
+
+class FakeLivy:
+    """
+    the sessions and statements, with their states worked out from the time they were created
+    """
+
+    def __init__(self, startup, statement_seconds, log_rate, log_buffer=LOG_BUFFER_LINES):
+        self.startup = startup
+        self.statement_seconds = statement_seconds
+        self.log_rate = log_rate
+        self.log_buffer = log_buffer
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.log_bytes = 0
+
+    def create_session(self, kind, name=None):
+        with self.lock:
+            if name and any(session['name'] == name for session in self.sessions.values()):
+                return None
+            session_id = len(self.sessions)
+            self.sessions[session_id] = {'id': session_id, 'kind': kind, 'name': name, 'created': time.time(),
+                                         'statements': [], 'deleted': False}
+        return self.session_json(session_id)
+
+    def _session_state(self, session):
+        now = time.time()
+        if session['deleted']:
+            return 'dead'
+        if now < session['created'] + self.startup:
+            return 'starting'
+        if any(now < statement['finishes'] for statement in session['statements']):
+            return 'busy'
+        return 'idle'
+
+    def session_json(self, session_id):
+        session = self.sessions[session_id]
+        return {'id': session_id, 'name': session['name'], 'kind': session['kind'], 'state': self._session_state(session),
+                'appId': 'application_{}'.format(session_id), 'log': []}
+
+    def submit(self, session_id, code):
+        session = self.sessions[session_id]
+        match = re.search(r'#\s*seconds:\s*([0-9.]+)', code)
+        seconds = float(match.group(1)) if match else self.statement_seconds
+        with self.lock:
+            starts = max([time.time()] + [statement['finishes'] for statement in session['statements']])
+            statement = {'id': len(session['statements']), 'code': code, 'starts': starts, 'finishes': starts + seconds}
+            session['statements'].append(statement)
+        return self.statement_json(session_id, statement['id'])
+
+    def statement_json(self, session_id, statement_id):
+        statement = self.sessions[session_id]['statements'][statement_id]
+        now = time.time()
+        result = {'id': statement_id, 'code': statement['code'], 'output': None,
+                  'started': int(statement['starts'] * 1000) if now >= statement['starts'] else 0,
+                  'completed': int(statement['finishes'] * 1000) if now >= statement['finishes'] else 0,
+                  'progress': min(1.0, max(0.0, (now - statement['starts']) / max(statement['finishes'] - statement['starts'], 1e-9)))}
+        if now < statement['starts']:
+            result['state'] = 'waiting'
+        elif now < statement['finishes']:
+            result['state'] = 'running'
+        else:
+            result['state'] = 'available'
+            if 'raise' in statement['code']:
+                result['output'] = {'status': 'error', 'execution_count': statement_id, 'ename': 'Error',
+                                    'evalue': 'the statement raised', 'traceback': ['Traceback', '  line 1']}
+            else:
+                result['output'] = {'status': 'ok', 'execution_count': statement_id,
+                                    'data': {'text/plain': 'ran statement {}'.format(statement_id)}}
+        return result
+
+    def log(self, session_id):
+        """
+        the log lines of a session still in the buffer, which grow while its statements run
+        """
+        session = self.sessions[session_id]
+        now = time.time()
+        running = sum(max(0.0, min(now, statement['finishes']) - statement['starts'])
+                      for statement in session['statements'])
+        lines = ['{} INFO spark startup line {}'.format(session_id, i) for i in range(20)]
+        lines += ['{} INFO TaskSetManager: finished task {} of the running statements'.format(session_id, i)
+                  for i in range(int(running * self.log_rate))]
+        return lines[-self.log_buffer:]
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, so a pooled client reuses its connections
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.livy.lock:
+            self.server.livy.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return len(data)
+
+    def _route(self, method):
+        livy = self.server.livy
+        with livy.lock:
+            livy.requests += 1
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else {}
+        try:
+            if parts == ['sessions'] and method == 'POST':
+                session = livy.create_session(body.get('kind', 'spark'), body.get('name'))
+                if session is None:
+                    return self._send(400, {'msg': 'Duplicate session name: {}'.format(body['name'])})
+                return self._send(201, session)
+            if parts == ['sessions'] and method == 'GET':
+                query = parse_qs(url.query)
+                start = int(query.get('from', [0])[0])
+                size = int(query.get('size', [100])[0])
+                ids = [session_id for session_id in sorted(livy.sessions) if not livy.sessions[session_id]['deleted']]
+                return self._send(200, {'from': start, 'total': len(ids),
+                                        'sessions': [livy.session_json(session_id) for session_id in ids[start:start + size]]})
+            session_id = int(parts[1])
+            if session_id not in livy.sessions or livy.sessions[session_id]['deleted']:
+                return self._send(404, {'msg': 'Session {} not found.'.format(session_id)})
+            if len(parts) == 2 and method == 'GET':
+                return self._send(200, livy.session_json(session_id))
+            if len(parts) == 2 and method == 'DELETE':
+                livy.sessions[session_id]['deleted'] = True
+                return self._send(200, {'msg': 'deleted'})
+            if parts[2:] == ['log'] and method == 'GET':
+                lines = livy.log(session_id)
+                query = parse_qs(url.query)
+                size = int(query.get('size', [100])[0])
+                start = int(query.get('from', [max(0, len(lines) - size)])[0])
+                sent = self._send(200, {'id': session_id, 'from': start, 'total': len(lines),
+                                        'log': lines[start:start + size]})
+                with livy.lock:
+                    livy.log_bytes += sent
+                return sent
+            if parts[2:] == ['statements'] and method == 'GET':
+                statements = [livy.statement_json(session_id, statement['id'])
+                              for statement in livy.sessions[session_id]['statements']]
+                return self._send(200, {'total_statements': len(statements), 'statements': statements})
+            if parts[2:] == ['statements'] and method == 'POST':
+                return self._send(201, livy.submit(session_id, body['code']))
+            if len(parts) == 4 and parts[2] == 'statements' and method == 'GET':
+                return self._send(200, livy.statement_json(session_id, int(parts[3])))
+        except (IndexError, ValueError, KeyError):
+            pass
+        return self._send(404, {'msg': 'no route for {} {}'.format(method, url.path)})
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+
+def make_server(port=8998, startup=STARTUP_SECONDS, statement_seconds=STATEMENT_SECONDS, log_rate=LOG_LINES_PER_SECOND,
+                log_buffer=LOG_BUFFER_LINES):
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.livy = FakeLivy(startup, statement_seconds, log_rate, log_buffer)
+    return server
+
+
+def main(argv):
+    port = 8998
+    startup = STARTUP_SECONDS
+    statement_seconds = STATEMENT_SECONDS
+    log_rate = LOG_LINES_PER_SECOND
+    log_buffer = LOG_BUFFER_LINES
+    try:
+        opts, args = getopt.getopt(argv, "hp:s:d:l:b:", ["port=", "startup=", "statement_seconds=", "log_rate=",
+                                                         "log_buffer="])
+    except getopt.GetoptError:
+        print('fake-livy-server.py -p <port> -s <startup seconds> -d <statement seconds> -l <log lines per second> -b <log buffer lines>')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('fake-livy-server.py -p <port> -s <startup seconds> -d <statement seconds> -l <log lines per second> -b <log buffer lines>')
+            sys.exit()
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-s", "--startup"):
+            startup = float(arg)
+        elif opt in ("-d", "--statement_seconds"):
+            statement_seconds = float(arg)
+        elif opt in ("-l", "--log_rate"):
+            log_rate = float(arg)
+        elif opt in ("-b", "--log_buffer"):
+            log_buffer = int(arg)
+
+    server = make_server(port, startup, statement_seconds, log_rate, log_buffer)
+    print('fake Livy listening on http://127.0.0.1:{}'.format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    livy = server.livy
+    print('{} requests over {} connections, {:.1f} KB of logs served'.format(
+        livy.requests, livy.connections, livy.log_bytes / 1024))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
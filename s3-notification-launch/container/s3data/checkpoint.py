@@ -0,0 +1,171 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+def idempotency_key(bucket, key, etag, row_number):
+    """
+    a key that is the same for a given row of a given object version on every run
+    """
+    source = '{}/{}#{}:{}'.format(bucket, key, etag, row_number)
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:32]
+
+
+class LocalFileCheckpointStore:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state):
+        # write then rename so a crash mid-write never leaves a torn checkpoint
+        tmp_path = self.path + '.tmp'
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class S3CheckpointStore:
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+    def load(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def save(self, state):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(state).encode('utf-8'))
+
+    def clear(self):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.key)
+
+
+class LocalObjectClient:
+    """
+    stand-in for the S3 client calls used by S3CheckpointStore, backed by a local directory
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def get_object(self, Bucket, Key):
+        try:
+            with open(self._path(Bucket, Key), 'rb') as f:
+                return {'Body': io.BytesIO(f.read())}
+        except FileNotFoundError:
+            raise self.exceptions.NoSuchKey(Key)
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+
+def store_for_object(uri, object_key, s3_client):
+    """
+    :param uri: s3://bucket/prefix for S3 checkpoints, anything else is a local directory
+    :param object_key: the key of the object being extracted, one checkpoint is kept per object
+    """
+    name = object_key + '.checkpoint.json'
+    if uri.startswith('s3://'):
+        bucket, _, prefix = uri[5:].partition('/')
+        key = prefix.rstrip('/') + '/' + name if prefix else name
+        return S3CheckpointStore(s3_client, bucket, key)
+    return LocalFileCheckpointStore(os.path.join(uri, name))
+
+
+class Checkpointer:
+    """
+    periodically saves how far into an object the publisher has acknowledged, so a
+    restarted job can pick up from the first unpublished row
+    """
+
+    def __init__(self, store, bucket, key, etag, interval=30):
+        self.store = store
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.interval = interval
+        # whatever is needed to parse the object again from the saved offset
+        self.params = {}
+        self._last_save = time.monotonic()
+        self._saved_batch = -1
+        self._batch_base = 0
+
+    def resume(self):
+        """
+        :return: (offset, row_number, params) to continue from, or None to start from the beginning
+        """
+        state = self.store.load()
+        if not state:
+            return None
+        if (state['bucket'], state['key'], state['etag']) != (self.bucket, self.key, self.etag):
+            log.warning('ignoring checkpoint for a different version of %s', self.key)
+            return None
+        self.params = state['params']
+        self._batch_base = state['batch'] + 1
+        return state['offset'], state['row'], state['params']
+
+    def maybe_save(self, publisher):
+        if time.monotonic() - self._last_save >= self.interval:
+            self.save(publisher)
+
+    def save(self, publisher):
+        self._last_save = time.monotonic()
+        batch, marker = publisher.acknowledged
+        if marker is None or batch == self._saved_batch:
+            return
+        offset, row_number = marker
+        self.store.save({
+            'bucket': self.bucket,
+            'key': self.key,
+            'etag': self.etag,
+            'params': self.params,
+            'offset': offset,
+            'row': row_number,
+            'batch': self._batch_base + batch
+        })
+        self._saved_batch = batch
+
+    def clear(self):
+        self.store.clear()
@@ -1,56 +1,213 @@
 import boto3
 import time
 import os
-import csv
-from datetime import datetime
 import json
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def main():
+from checkpoint import Checkpointer, idempotency_key, store_for_object
+from metrics import Metrics
+from publisher import EventPublisher
+from reader import decompress, detect_codec, detect_delimiter, open_object, peek, read_rows, skip_bytes
+
+log = logging.getLogger(__name__)
+
+# rows counted locally before being added to the shared metrics
+METRICS_ROW_STRIDE = 100
+
+
+def load_config():
+    return {
+        'read_mode': os.environ.get('READ_MODE', 'stream'),
+        'read_concurrency': int(os.environ.get('READ_CONCURRENCY', '4')),
+        'part_size': int(os.environ.get('READ_PART_SIZE_MB', '8')) * 1024 * 1024,
+        'max_in_flight': int(os.environ.get('PUBLISH_CONCURRENCY', '4')),
+        # 'auto' sniffs the delimiter from the first lines of each object
+        'delimiter': os.environ.get('DELIMITER', 'auto'),
+        # e.g. s3://bucket/checkpoints or /mnt/efs/checkpoints, unset to disable
+        'checkpoint_uri': os.environ.get('CHECKPOINT_URI'),
+        'checkpoint_interval': float(os.environ.get('CHECKPOINT_INTERVAL_SECONDS', '30')),
+        'metrics_namespace': os.environ.get('METRICS_NAMESPACE', 'S3DataExtractor'),
+        'metrics_interval': float(os.environ.get('METRICS_INTERVAL_SECONDS', '60')),
+        # with LOG_LEVEL=DEBUG, every Nth row is logged
+        'log_sample_every': int(os.environ.get('LOG_SAMPLE_EVERY', '1000')),
+    }
+
+
+def list_keys(s3_client, bucket, prefix=None, manifest_key=None):
+    """
+    resolve the objects to extract from a prefix or a manifest object
+    :param manifest_key: an object holding a json list of keys or one key per line
+    """
+    if manifest_key:
+        body = s3_client.get_object(Bucket=bucket, Key=manifest_key)['Body'].read().decode('utf-8')
+        if body.lstrip().startswith('['):
+            return json.loads(body)
+        return [line.strip() for line in body.splitlines() if line.strip()]
+
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/') and obj['Size'] > 0:
+                keys.append(obj['Key'])
+    return keys
+
+
+def process_object(bucket, key, config):
+    """
+    extract every row of one object and publish it to EventBridge. Clients are created
+    here so this can run in a worker process.
+    :return: the metrics summary for the object
+    """
     event_bridge = boto3.client('events')
+    s3_client = boto3.client('s3')
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    log.info('S3 Object Key %s', key)
+
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    etag = head['ETag'].strip('"')
+
+    offset, row_number, params = 0, 0, None
+    checkpointer = None
+    if config['checkpoint_uri']:
+        checkpointer = Checkpointer(store_for_object(config['checkpoint_uri'], key, s3_client), bucket, key,
+                                    etag, interval=config['checkpoint_interval'])
+        resumed = checkpointer.resume()
+        if resumed:
+            offset, row_number, params = resumed
+            log.info('resuming %s after row %d at byte %d', key, row_number, offset)
+
+    if params is None:
+        codec = detect_codec(key, head.get('ContentEncoding'))
+    else:
+        codec = params['codec']
+
+    # offsets count decompressed bytes, so compressed objects are re-read and skipped forward
+    start = offset if codec is None else 0
+    chunks = open_object(s3_client, bucket, key, mode=config['read_mode'], part_size=config['part_size'],
+                         concurrency=config['read_concurrency'], start=start, size=head['ContentLength'])
+
+    if params is None:
+        first, chunks = peek(chunks)
+        if codec is None:
+            codec = detect_codec(key, first_bytes=first)
+        chunks = decompress(chunks, codec)
+        delimiter = config['delimiter']
+        if delimiter == 'auto':
+            sample, chunks = peek(chunks)
+            delimiter = detect_delimiter(sample, key)
+        params = {'codec': codec, 'delimiter': delimiter}
+    else:
+        chunks = decompress(chunks, codec)
+        if codec is not None:
+            chunks = skip_bytes(chunks, offset)
+
+    log.info('reading %s in %s mode, compression %s, delimiter %r',
+             key, config['read_mode'], codec or 'none', params['delimiter'])
+
+    metrics = Metrics(namespace=config['metrics_namespace'], properties={'ObjectKey': key})
+    metrics.start(config['metrics_interval'])
+    sample_every = config['log_sample_every']
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    publisher = EventPublisher(event_bridge, max_in_flight=config['max_in_flight'], metrics=metrics)
+    try:
+        with publisher:
+            reader, counter = read_rows(chunks, delimiter=params['delimiter'], offset=offset)
+            if 'headers' not in params:
+                params['headers'] = next(reader)
+            headers = params['headers']
+            if checkpointer:
+                checkpointer.params = params
+            counted_rows, counted_offset = 0, counter.offset
+            for row in reader:
+                row_number += 1
+                event = {
+                    'status': 'extracted',
+                    'headers': ','.join(headers),
+                    'data': ','.join(row),
+                    'idempotency_key': idempotency_key(bucket, key, etag, row_number)
+                }
+                if debug and row_number % sample_every == 0:
+                    log.debug('row %d: %s', row_number, event)
+                publisher.publish(event, marker=(counter.offset, row_number))
+                counted_rows += 1
+                if counted_rows == METRICS_ROW_STRIDE:
+                    metrics.add_rows(counted_rows, counter.offset - counted_offset)
+                    counted_rows, counted_offset = 0, counter.offset
+                if checkpointer:
+                    checkpointer.maybe_save(publisher)
+            metrics.add_rows(counted_rows, counter.offset - counted_offset)
+    finally:
+        if checkpointer:
+            # record whatever was acknowledged, including after a failure
+            checkpointer.save(publisher)
+        summary = metrics.stop()
+
+    if checkpointer:
+        checkpointer.clear()
+
+    log.info('published %d events from %s at %.0f rows/s', publisher.published, key, summary['RowsPerSecond'])
+    return summary
+
+
+def log_summary(summaries, elapsed):
+    rows = sum(summary['Rows'] for summary in summaries)
+    log.info('extracted %d rows from %d objects in %.1fs (%.0f rows/s, %d entries retried, %d failed)',
+             rows, len(summaries), elapsed, rows / max(elapsed, 1e-6),
+             sum(summary['RetriedEntries'] for summary in summaries),
+             sum(summary['FailedEntries'] for summary in summaries))
+
+
+def main():
     # https://stackoverflow.com/questions/4906977/how-to-access-environment-variable-values
 
     data_s3_bucket_name = os.environ.get('S3_BUCKET_NAME')
     data_s3_object_key  = os.environ.get('S3_OBJECT_KEY')
+    data_s3_prefix = os.environ.get('S3_PREFIX')
+    data_s3_manifest_key = os.environ.get('S3_MANIFEST_KEY')
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 
-    if (None == data_s3_bucket_name or None == data_s3_object_key):
-        print('ERROR: unable to retrieve environment variables (s3 bucket or object key, stream name')
+    if (not data_s3_bucket_name or not (data_s3_object_key or data_s3_prefix or data_s3_manifest_key)):
+        log.error('unable to retrieve environment variables (s3 bucket and one of object key, prefix or manifest key)')
         exit(1)
 
-    print('Bucket Name ' + data_s3_bucket_name)
-    print('S3 Object Key ' + data_s3_object_key)
-
-    local_file = '/tmp/data.tsv'
-
-    s3_resource = boto3.resource('s3')
-    s3_resource.Object(data_s3_bucket_name, data_s3_object_key).download_file(local_file)
-
-    print('SUCCESS: data file downloaded: ' + local_file)
-
-
-    with open(local_file) as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        headers = next(reader)
-        for row in reader:
-            print(', '.join(row))
-            event = {
-                'status': 'extracted',
-                'headers': ','.join(headers),
-                'data': ','.join(row)
-            }
-            print(event)
-            response = event_bridge.put_events(
-                 Entries=[
-                     {
-                        'DetailType': 's3.record.extraction',
-                        'EventBusName': 'default',
-                        'Source': 'batch.upload-etl',
-                        'Time': datetime.now(),
-                        'Detail': json.dumps(event)
-                        
-                    },
-                ]
-            )
+    log.info('Bucket Name %s', data_s3_bucket_name)
+
+    config = load_config()
+
+    if data_s3_object_key:
+        keys = [data_s3_object_key]
+    else:
+        keys = list_keys(boto3.client('s3'), data_s3_bucket_name, data_s3_prefix, data_s3_manifest_key)
+    log.info('%d objects to extract', len(keys))
+
+    started = time.monotonic()
+    workers = min(int(os.environ.get('WORKER_PROCESSES', os.cpu_count() or 1)), len(keys))
+    if workers <= 1:
+        summaries = [process_object(data_s3_bucket_name, key, config) for key in keys]
+        log_summary(summaries, time.monotonic() - started)
+        exit(0)
+
+    failed = []
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_object, data_s3_bucket_name, key, config): key for key in keys}
+        for future in as_completed(futures):
+            try:
+                summaries.append(future.result())
+            except Exception:
+                log.exception('extracting %s failed', futures[future])
+                failed.append(futures[future])
+
+    log_summary(summaries, time.monotonic() - started)
+    if failed:
+        log.error('%d of %d objects failed', len(failed), len(keys))
+        exit(1)
     exit(0)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,166 @@
+import json
+import math
+import sys
+import threading
+import time
+
+# latency buckets grow by 5% so percentiles are within 5% of the true value
+BUCKET_GROWTH = 1.05
+_LOG_GROWTH = math.log(BUCKET_GROWTH)
+
+
+class Histogram:
+    """
+    fixed-precision latency histogram with constant memory regardless of sample count
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+
+    def add(self, value_ms):
+        bucket = int(math.log(max(value_ms, 0.001)) / _LOG_GROWTH)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return BUCKET_GROWTH ** (bucket + 1)
+        return BUCKET_GROWTH ** (max(self.counts) + 1)
+
+
+class Metrics:
+    """
+    throughput and put_events latency counters for one extraction, written out as
+    CloudWatch Embedded Metric Format lines
+    """
+
+    def __init__(self, namespace='S3DataExtractor', dimensions=None, properties=None, entries_per_batch=10,
+                 out=sys.stdout):
+        self.namespace = namespace
+        self.dimensions = dimensions or {'Service': 's3data'}
+        self.properties = properties or {}
+        self.entries_per_batch = entries_per_batch
+        self.out = out
+
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._totals = self._new_window()
+        self._window = self._new_window()
+        self._window_started = self._started
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _new_window():
+        return {'rows': 0, 'bytes': 0, 'batches': 0, 'entries': 0, 'retries': 0, 'failed': 0,
+                'latency': Histogram()}
+
+    def add_rows(self, rows, byte_count):
+        with self._lock:
+            for window in (self._window, self._totals):
+                window['rows'] += rows
+                window['bytes'] += byte_count
+
+    def add_batch(self, entries, latency_ms):
+        """
+        record one put_events call and the number of entries it carried
+        """
+        with self._lock:
+            for window in (self._window, self._totals):
+                window['batches'] += 1
+                window['entries'] += entries
+                window['latency'].add(latency_ms)
+
+    def add_retries(self, entries):
+        with self._lock:
+            self._window['retries'] += entries
+            self._totals['retries'] += entries
+
+    def add_failed(self, entries):
+        with self._lock:
+            self._window['failed'] += entries
+            self._totals['failed'] += entries
+
+    def start(self, interval):
+        """
+        emit a metrics line every interval seconds from a background thread
+        """
+        def run():
+            while not self._stop.wait(interval):
+                self.emit()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop the interval emitter, write the last interval and then the summary for the whole run
+        :return: the summary values
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        # flush the partial interval so every row shows up in an EMF line
+        self.emit()
+        with self._lock:
+            summary = self._values(self._totals, time.monotonic() - self._started)
+        self._write(summary, final=True)
+        return summary
+
+    def emit(self):
+        now = time.monotonic()
+        with self._lock:
+            window, self._window = self._window, self._new_window()
+            elapsed, self._window_started = now - self._window_started, now
+        self._write(self._values(window, elapsed))
+
+    def _values(self, window, elapsed):
+        elapsed = max(elapsed, 1e-6)
+        batches = window['batches']
+        return {
+            'Rows': window['rows'],
+            'RowsPerSecond': window['rows'] / elapsed,
+            'BytesPerSecond': window['bytes'] / elapsed,
+            'BatchFillRatio': window['entries'] / (batches * self.entries_per_batch) if batches else 0.0,
+            'PutEventsLatencyP50': window['latency'].percentile(50),
+            'PutEventsLatencyP99': window['latency'].percentile(99),
+            'RetriedEntries': window['retries'],
+            'FailedEntries': window['failed'],
+        }
+
+    def _write(self, values, final=False):
+        units = {
+            'Rows': 'Count',
+            'RowsPerSecond': 'Count/Second',
+            'BytesPerSecond': 'Bytes/Second',
+            'BatchFillRatio': 'None',
+            'PutEventsLatencyP50': 'Milliseconds',
+            'PutEventsLatencyP99': 'Milliseconds',
+            'RetriedEntries': 'Count',
+            'FailedEntries': 'Count',
+        }
+        line = {}
+        # the summary repeats what the interval lines already reported, so it is logged
+        # without the metric directive to keep CloudWatch from counting rows twice
+        if not final:
+            line['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()]
+                }]
+            }
+        line.update(self.dimensions)
+        line.update(self.properties)
+        line.update(values)
+        line['Summary'] = final
+        self.out.write(json.dumps(line) + '\n')
+        self.out.flush()
@@ -0,0 +1,217 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# PutEvents limits: at most 10 entries and 256 KB per request
+MAX_ENTRIES_PER_REQUEST = 10
+MAX_REQUEST_BYTES = 256 * 1024
+
+# an entry's Time field is always counted as 14 bytes
+TIME_FIELD_BYTES = 14
+
+
+def entry_size(entry):
+    """
+    size of a PutEvents entry as EventBridge counts it towards the request limit
+    :param entry: a PutEvents request entry
+    :return: the size in bytes
+    """
+    size = TIME_FIELD_BYTES if 'Time' in entry else 0
+    for field in ('Source', 'DetailType', 'Detail'):
+        if field in entry:
+            size += len(entry[field].encode('utf-8'))
+    for resource in entry.get('Resources', []):
+        size += len(resource.encode('utf-8'))
+    return size
+
+
+class PublishError(Exception):
+    pass
+
+
+class EventPublisher:
+    """
+    packs events into PutEvents batches and keeps a bounded number of batches in flight
+    on a thread pool. Only the entries EventBridge reports as failed are retried.
+    """
+
+    def __init__(self, client, source='batch.upload-etl', detail_type='s3.record.extraction',
+                 event_bus_name='default', max_in_flight=4, max_attempts=5, base_backoff=0.1, metrics=None):
+        self.client = client
+        self.source = source
+        self.detail_type = detail_type
+        self.event_bus_name = event_bus_name
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.metrics = metrics
+
+        self.published = 0
+        self.failed = 0
+
+        self._entries = []
+        self._marker = None
+        self._next_batch = 0
+        # highest batch number such that it and every batch before it has been published
+        self._acked_batch = -1
+        self._acked_marker = None
+        self._completed = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._errors = []
+        self._futures = set()
+        # one permit per batch that is running or queued on the pool
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    @property
+    def acknowledged(self):
+        """
+        the last batch number and marker up to which every event has been published
+        """
+        with self._lock:
+            return self._acked_batch, self._acked_marker
+
+    def publish(self, detail, marker=None):
+        """
+        add an event to the current batch, sending the batch once it is full
+        :param detail: a json serializable event detail
+        :param marker: an opaque position reported by acknowledged once this event is published
+        """
+        entry = {
+            'DetailType': self.detail_type,
+            'EventBusName': self.event_bus_name,
+            'Source': self.source,
+            'Time': datetime.now(),
+            'Detail': json.dumps(detail)
+        }
+        size = entry_size(entry)
+        if size > MAX_REQUEST_BYTES:
+            raise PublishError('event of {} bytes exceeds the PutEvents request limit'.format(size))
+
+        if self._size + size > MAX_REQUEST_BYTES:
+            self._send()
+        self._entries.append(entry)
+        self._size += size
+        self._marker = marker
+        if len(self._entries) == MAX_ENTRIES_PER_REQUEST:
+            self._send()
+
+    def flush(self):
+        """
+        send the partial batch and wait for every batch in flight
+        :raises PublishError: if any batch could not be published
+        """
+        self._send()
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if not futures:
+                break
+            for future in futures:
+                future.result()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise PublishError('{} batches failed, first error: {}'.format(len(errors), errors[0]))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
+
+    def _send(self):
+        if not self._entries:
+            return
+        entries, self._entries, self._size = self._entries, [], 0
+        batch = self._next_batch
+        self._next_batch += 1
+
+        self._raise_pending_error()
+        self._in_flight.acquire()
+        future = self._executor.submit(self._put_with_retry, batch, entries, self._marker)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        self._in_flight.release()
+
+    def _raise_pending_error(self):
+        # fail fast instead of reading the rest of the file once a batch has been given up on
+        with self._lock:
+            if self._errors:
+                error = self._errors[0]
+                raise PublishError('giving up on batch: {}'.format(error))
+
+    def _put_with_retry(self, batch, entries, marker):
+        attempt = 0
+        while entries:
+            attempt += 1
+            started = time.monotonic()
+            try:
+                response = self.client.put_events(Entries=entries)
+            except Exception as e:
+                if attempt >= self.max_attempts:
+                    self._give_up(entries, e)
+                    return
+                if self.metrics:
+                    self.metrics.add_retries(len(entries))
+                self._backoff(attempt)
+                continue
+            if self.metrics:
+                self.metrics.add_batch(len(entries), (time.monotonic() - started) * 1000)
+
+            if response.get('FailedEntryCount', 0) == 0:
+                self._record(len(entries))
+                self._acknowledge(batch, marker)
+                return
+
+            # Entries lines up with the request; failed ones carry an ErrorCode
+            failed = [entry for entry, result in zip(entries, response['Entries']) if 'ErrorCode' in result]
+            self._record(len(entries) - len(failed))
+            entries = failed
+
+            if attempt >= self.max_attempts:
+                codes = {result['ErrorCode'] for result in response['Entries'] if 'ErrorCode' in result}
+                self._give_up(entries, 'entries still failing: {}'.format(', '.join(sorted(codes))))
+                return
+            if self.metrics:
+                self.metrics.add_retries(len(entries))
+            self._backoff(attempt)
+
+    def _record(self, count):
+        with self._lock:
+            self.published += count
+
+    def _acknowledge(self, batch, marker):
+        with self._lock:
+            self._completed[batch] = marker
+            while self._acked_batch + 1 in self._completed:
+                self._acked_batch += 1
+                self._acked_marker = self._completed.pop(self._acked_batch)
+
+    def _give_up(self, entries, error):
+        with self._lock:
+            self.failed += len(entries)
+            self._errors.append(error)
+        if self.metrics:
+            self.metrics.add_failed(len(entries))
+
+    def _backoff(self, attempt):
+        # exponential backoff with full jitter
+        time.sleep(random.uniform(0, self.base_backoff * (2 ** attempt)))
@@ -0,0 +1,207 @@
+import csv
+import itertools
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+SNIFF_SIZE = 64 * 1024
+
+
+def split_lines(chunks):
+    """
+    re-split a stream of byte chunks into lines, joining lines cut at chunk boundaries
+    :param chunks: an iterable of bytes
+    :return: a generator of lines, each still ending with its newline (except possibly the last)
+    """
+    carry = b''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (carry + chunk).split(b'\n')
+        carry = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if carry:
+        yield carry
+
+
+def stream_chunks(body, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    read a get_object body in fixed size chunks
+    :param body: a botocore StreamingBody or any object with read(size)
+    :param chunk_size: the read size in bytes
+    """
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def ranged_chunks(s3_client, bucket, key, size, part_size=DEFAULT_PART_SIZE, concurrency=4, start=0):
+    """
+    fetch an object as byte ranges in parallel and yield them in order. At most
+    concurrency parts are held in memory at any time.
+    :param size: the object size in bytes
+    :param start: the byte offset to start reading from
+    """
+    ranges = ((offset, min(offset + part_size, size) - 1) for offset in range(start, size, part_size))
+
+    def fetch(byte_range):
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range='bytes={}-{}'.format(*byte_range))
+        return response['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for byte_range in ranges:
+            if len(pending) == concurrency:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fetch, byte_range))
+        while pending:
+            yield pending.popleft().result()
+
+
+class LineCounter:
+    """
+    decodes lines for csv.reader while tracking the byte offset and number of lines consumed.
+    csv.reader pulls exactly the lines of one row before yielding it, so after each row
+    offset is the position where the next row starts.
+    """
+
+    def __init__(self, lines, offset=0, encoding='utf-8'):
+        self.lines = lines
+        self.offset = offset
+        self.encoding = encoding
+
+    def __iter__(self):
+        for line in self.lines:
+            self.offset += len(line)
+            yield line.decode(self.encoding)
+
+
+def open_object(s3_client, bucket, key, mode='stream', part_size=DEFAULT_PART_SIZE, concurrency=4, start=0,
+                size=None):
+    """
+    open an S3 object as a stream of byte chunks without staging it on disk
+    :param mode: 'stream' reads the get_object body sequentially, 'ranged' issues parallel ranged GETs
+    :param start: the byte offset to start reading from
+    :param size: the object size if already known
+    :return: an iterable of bytes
+    """
+    if size is not None and start >= size:
+        return iter(())
+    if mode == 'ranged':
+        if size is None:
+            size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        return ranged_chunks(s3_client, bucket, key, size, part_size, concurrency, start)
+    if mode == 'stream':
+        params = {'Bucket': bucket, 'Key': key}
+        if start:
+            params['Range'] = 'bytes={}-'.format(start)
+        return stream_chunks(s3_client.get_object(**params)['Body'])
+    raise ValueError('unknown read mode: ' + mode)
+
+
+def read_rows(chunks, delimiter=',', offset=0):
+    """
+    parse csv rows from a stream of byte chunks
+    :return: a csv reader and the LineCounter feeding it
+    """
+    counter = LineCounter(split_lines(chunks), offset)
+    return csv.reader(counter, delimiter=delimiter), counter
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def detect_codec(key, content_encoding=None, first_bytes=b''):
+    """
+    work out how an object is compressed from its extension, Content-Encoding or magic bytes
+    :return: 'gzip', 'zstd' or None for uncompressed
+    """
+    name = key.lower()
+    encoding = (content_encoding or '').lower()
+    if name.endswith(('.gz', '.gzip')) or encoding == 'gzip' or first_bytes.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if name.endswith(('.zst', '.zstd')) or encoding == 'zstd' or first_bytes.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def gunzip_chunks(chunks):
+    # wbits=31 expects a gzip header; loop on unused_data to handle multi-member files
+    decompressor = zlib.decompressobj(wbits=31)
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(wbits=31)
+    yield decompressor.flush()
+
+
+def unzstd_chunks(chunks):
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstandard is required to read zstd compressed objects')
+    # like gzip members, pzstd output and concatenated parts hold several frames and a
+    # decompressobj stops at the end of the first one
+    dctx = zstandard.ZstdDecompressor()
+    decompressor = dctx.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data if decompressor.eof else b''
+            if decompressor.eof:
+                decompressor = dctx.decompressobj()
+
+
+def decompress(chunks, codec):
+    if codec is None:
+        return chunks
+    if codec == 'gzip':
+        return gunzip_chunks(chunks)
+    if codec == 'zstd':
+        return unzstd_chunks(chunks)
+    raise ValueError('unknown compression: ' + codec)
+
+
+def peek(chunks):
+    """
+    :return: the first non-empty chunk and an iterator that still yields it
+    """
+    chunks = iter(chunks)
+    for chunk in chunks:
+        if chunk:
+            return chunk, itertools.chain([chunk], chunks)
+    return b'', chunks
+
+
+def skip_bytes(chunks, count):
+    """
+    drop the first count bytes of a chunk stream, used to resume inside a compressed object
+    """
+    for chunk in chunks:
+        if count >= len(chunk):
+            count -= len(chunk)
+            continue
+        yield chunk[count:]
+        count = 0
+
+
+def detect_delimiter(sample, key, encoding='utf-8'):
+    """
+    sniff the delimiter from the first lines of an object, falling back on its extension
+    """
+    text = sample[:SNIFF_SIZE].decode(encoding, errors='ignore')
+    # only sniff complete lines so a truncated last line cannot skew the guess
+    if '\n' in text:
+        text = text[:text.rindex('\n')]
+    try:
+        return csv.Sniffer().sniff(text, delimiters=',\t|;').delimiter
+    except csv.Error:
+        return '\t' if '.tsv' in key.lower() else ','
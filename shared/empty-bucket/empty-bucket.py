@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import boto3
+import random
+import threading
+import traceback
+import cfnresponse
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+LIST_CONCURRENCY = int(os.environ.get('list_concurrency', '8'))
+DELETE_CONCURRENCY = int(os.environ.get('delete_concurrency', '16'))
+# characters to split a key range at, after the prefix shared by its first page. A range is
+# split over the class of the next character only, keys seldom mix classes at one position
+SPLIT_CLASSES = ('0123456789', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+SPLIT_CHARS = '-./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+# time left for in flight deletes and the next invocation before the Lambda is stopped
+TIME_MARGIN_MS = 60 * 1000
+# a custom resource gets an hour, which is four 15 minute invocations
+MAX_INVOCATIONS = 4
+MAX_ATTEMPTS = 8
+BASE_BACKOFF = 0.2
+RETRYABLE_ERRORS = ('SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout')
+
+s3client = boto3.client('s3', config=Config(max_pool_connections=LIST_CONCURRENCY + DELETE_CONCURRENCY))
+
+
+def _backoff(attempt):
+    time.sleep(BASE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+class BatchDeleter:
+    """
+    deletes batches of up to 1000 object versions from a thread pool, backing off and
+    retrying the keys S3 reports as throttled
+    """
+
+    def __init__(self, bucket_name, concurrency=DELETE_CONCURRENCY):
+        self.bucket_name = bucket_name
+        self.deleted = 0
+        self._lock = threading.Lock()
+        # listers wait rather than queue up more batches than the pool can work on
+        self._in_flight = threading.BoundedSemaphore(concurrency * 2)
+        self._pool = ThreadPoolExecutor(max_workers=concurrency)
+        self._futures = []
+
+    def submit(self, objects):
+        if not objects:
+            return
+        self._in_flight.acquire()
+        future = self._pool.submit(self._delete, objects)
+        future.add_done_callback(lambda _: self._in_flight.release())
+        self._futures.append(future)
+
+    def close(self):
+        """
+        wait for every batch and raise the first error
+        """
+        self._pool.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+
+    def _delete(self, objects):
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                response = s3client.delete_objects(Bucket=self.bucket_name,
+                                                   Delete={'Objects': objects, 'Quiet': True})
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                    raise
+                _backoff(attempt)
+                continue
+
+            errors = response.get('Errors', [])
+            with self._lock:
+                self.deleted += len(objects) - len(errors)
+            if not errors:
+                return
+            for error in errors:
+                if error['Code'] not in RETRYABLE_ERRORS:
+                    raise RuntimeError('cannot delete {} version {}: {}'.format(
+                        error['Key'], error.get('VersionId'), error['Message']))
+            objects = [{'Key': error['Key'], 'VersionId': error['VersionId']} for error in errors]
+            _backoff(attempt)
+        raise RuntimeError('gave up deleting {} versions from {}'.format(len(objects), self.bucket_name))
+
+
+def _versions(page):
+    return [{'Key': version['Key'], 'VersionId': version['VersionId']}
+            for version in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+
+
+def split_range(first_key, key_marker, version_marker, upper):
+    """
+    split the rest of a key range at the characters that can follow the prefix shared by the
+    first and the last key listed so far, so keys directly under one prefix are sharded as
+    well as keys under different prefixes
+    :return: (key marker, version id marker, upper bound) shards that together cover the rest
+    """
+    prefix = os.path.commonprefix([first_key, key_marker])
+    next_char = key_marker[len(prefix):len(prefix) + 1]
+    chars = next((chars for chars in SPLIT_CLASSES if next_char and next_char in chars), SPLIT_CHARS)
+    shards = []
+    for c in chars:
+        bound = prefix + c
+        if bound > key_marker and (upper is None or bound < upper):
+            shards.append((key_marker, version_marker, bound))
+            key_marker, version_marker = bound, None
+    shards.append((key_marker, version_marker, upper))
+    return shards
+
+
+class RangeLister:
+    """
+    lists the versions of a bucket in key ranges on a thread pool and hands them to a
+    BatchDeleter. A range is split once its first page shows there is more, for as long as
+    there are idle listers. A range holds the keys after its key marker up to and including
+    its upper bound.
+    """
+
+    def __init__(self, bucket_name, deleter, out_of_time, concurrency=LIST_CONCURRENCY):
+        self.bucket_name = bucket_name
+        self.deleter = deleter
+        self.out_of_time = out_of_time
+        self.concurrency = concurrency
+        self.completed = True
+        self.error = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._done = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    def run(self):
+        """
+        :return: whether every range was listed to the end
+        """
+        self._submit((None, None, None))
+        self._done.wait()
+        self._pool.shutdown(wait=True)
+        if self.error:
+            raise self.error
+        return self.completed
+
+    def _submit(self, shard):
+        with self._lock:
+            self._pending += 1
+        self._pool.submit(self._run, shard)
+
+    def _run(self, shard):
+        try:
+            if not self._delete_range(*shard):
+                self.completed = False
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._done.set()
+
+    def _should_stop(self):
+        return self.error is not None or self.out_of_time()
+
+    def _delete_range(self, key_marker, version_marker, upper):
+        """
+        :return: False if it stopped early because the invocation is running out of time
+        """
+        first_key = None
+        while True:
+            params = {'Bucket': self.bucket_name}
+            if key_marker:
+                params['KeyMarker'] = key_marker
+                if version_marker:
+                    params['VersionIdMarker'] = version_marker
+            page = s3client.list_object_versions(**params)
+            versions = _versions(page)
+            in_range = [version for version in versions if upper is None or version['Key'] <= upper]
+            self.deleter.submit(in_range)
+            if len(in_range) < len(versions) or not page.get('IsTruncated'):
+                return True
+            if self._should_stop():
+                return False
+
+            key_marker, version_marker = page['NextKeyMarker'], page.get('NextVersionIdMarker')
+            first_key = first_key or min(version['Key'] for version in versions)
+            with self._lock:
+                idle = self._pending < self.concurrency
+            if idle:
+                shards = split_range(first_key, key_marker, version_marker, upper)
+                # keep listing when the keys so far give no place to split
+                if len(shards) > 1:
+                    for shard in shards:
+                        self._submit(shard)
+                    return True
+
+
+def delete_versions(bucket_name, out_of_time):
+    """
+    list the bucket in key ranges at the same time and delete what is listed as it goes
+    :return: (number of versions deleted, whether every range was listed to the end)
+    """
+    deleter = BatchDeleter(bucket_name)
+    try:
+        completed = RangeLister(bucket_name, deleter, out_of_time).run()
+    finally:
+        deleter.close()
+    return deleter.deleted, completed
+
+
+def is_empty(bucket_name):
+    response = s3client.list_object_versions(Bucket=bucket_name, MaxKeys=1)
+    return not response.get('Versions') and not response.get('DeleteMarkers')
+
+
+def continue_in_new_invocation(event, context, state):
+    """
+    hand the delete over to a fresh invocation of this function, which answers CloudFormation
+    """
+    payload = dict(event, EmptyBucketContinuation=state)
+    boto3.client('lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                                  Payload=json.dumps(payload).encode('utf-8'))
+
+
+def empty_bucket(event, context):
+    bucket_name = os.environ['bucket_name']
+
+    try:
+        if event['RequestType'] == 'Delete':
+            state = event.get('EmptyBucketContinuation', {'invocations': 0, 'deleted': 0})
+            state['invocations'] += 1
+            print("empty bucket: {} (invocation {})".format(bucket_name, state['invocations']))
+
+            deleted, completed = delete_versions(
+                bucket_name, lambda: context.get_remaining_time_in_millis() < TIME_MARGIN_MS)
+            state['deleted'] += deleted
+            print('deleted {} versions, {} in total'.format(deleted, state['deleted']))
+
+            # objects may still be written while the stack is deleted, only report success on an empty bucket
+            if not completed or not is_empty(bucket_name):
+                if state['invocations'] >= MAX_INVOCATIONS:
+                    raise RuntimeError('{} is still not empty after {} invocations'.format(
+                        bucket_name, state['invocations']))
+                continue_in_new_invocation(event, context, state)
+                return
+
+        cfnresponse.send(event, context, cfnresponse.SUCCESS, {})
+    except Exception:
+        traceback.print_exc()
+
+        cfnresponse.send(event, context, cfnresponse.FAILED, {})